@@ -1,10 +1,15 @@
 import streamlit as st
-import requests
 import pypdfium2 as pdfium
-from src.functions import functions_map, parse_function_call
+import hashlib
+import json
+import time
+import uuid
+from src.client import llm, retrieval
+from src.functions import check_function_call
 
-llm_url = "http://llm_app:8001"
-retrieval_url = "http://retrieval_app:8002"
+# every browser session has its own conversation in the LLM service
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 
 def clear_application_data():
@@ -20,13 +25,63 @@ def clear_application_data():
     if "selected_doc" in st.session_state:
         del st.session_state.selected_doc
 
-    requests.post(url=llm_url + "/reset")
-    requests.post(url=retrieval_url + "/reset")
+    llm.post("/reset", json={"session_id": st.session_state.session_id})
+    retrieval.post("/reset")
 
     # Optional: add a message to confirm clearing is done
     st.success("All data cleared successfully!")
 
 
+# width of the sidebar previews in pixels
+PREVIEW_WIDTH = 600
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def render_preview(content: bytes):
+    """Renders the first page at the resolution it is displayed with"""
+    pdf = pdfium.PdfDocument(content)
+    page = pdf[0]
+
+    return page.render(scale=PREVIEW_WIDTH / page.get_width()).to_pil()
+
+
+# seconds between two looks at an ingestion job
+JOB_POLL_SECONDS = 0.5
+
+
+def wait_for_job(job_id: str) -> dict:
+    """Shows the progress of an ingestion job until it is finished"""
+    progress_bar = st.progress(0.0, text="Queued")
+    while True:
+        job = retrieval.get(f"/jobs/{job_id}").json()
+        if job["status"] in ("done", "failed"):
+            progress_bar.empty()
+            return job
+
+        progress_bar.progress(job["progress"], text=job["stage"].capitalize())
+        time.sleep(JOB_POLL_SECONDS)
+
+
+def upload_once(file) -> dict:
+    """The name the file is stored under in the database, or the error of its
+    ingestion, as {"name": ..., "error": ...}"""
+    # every rerun sees all the uploaded files, each one is sent only once
+    if "uploaded_docs" not in st.session_state:
+        st.session_state.uploaded_docs = {}
+
+    content_hash = hashlib.sha256(file.getvalue()).hexdigest()
+    if content_hash not in st.session_state.uploaded_docs:
+        job = wait_for_job(upload_file(file).json()["job_id"])
+        if job["status"] == "failed":
+            upload = {"name": None, "error": job["error"]}
+        else:
+            # a file with known contents is stored under the known name
+            upload = {"name": job["duplicate_of"] or file.name, "error": None}
+        st.session_state.uploaded_docs[content_hash] = upload
+
+    return st.session_state.uploaded_docs[content_hash]
+
+
 def upload_file(file):
     # Since we're dealing with an UploadedFile object, we need to reset its position
     file.seek(0)  # Reset file pointer to the beginning
@@ -37,46 +92,56 @@ def upload_file(file):
             "multipart/form-data",
         )
     }
-    response = requests.post(url=retrieval_url + "/add_document", files=files)
+    response = retrieval.post("/add_document", files=files)
     return response
 
 
-def function_call(function_call_str: str) -> str:
-    parsed_call = parse_function_call(function_call_str)
+def llm_call_stream(prompt: str):
+    """Yields the response text piece by piece from the server-sent events"""
+    with llm.post(
+        "/generate_stream",
+        json={"prompt": prompt, "session_id": st.session_state.session_id},
+        stream=True,
+    ) as llm_response:
+        for line in llm_response.iter_lines(decode_unicode=True):
+            if line.startswith("event: done"):
+                break
 
-    if parsed_call is None:
-        return None
+            if line.startswith("data: "):
+                yield json.loads(line[len("data: ") :])
 
-    if isinstance(parsed_call, str):
-        return parsed_call
 
-    func_name = parsed_call.get("name")
-    func_args = parsed_call.get("arguments")
+def agent_resume(llm_response: str) -> str:
+    # The LLM service runs the function calls and the rest of the tool loop
+    agent_response = llm.post(
+        "/agent/resume",
+        json={
+            "response": llm_response,
+            "session_id": st.session_state.session_id,
+            "selected_document_name": st.session_state.get(
+                "selected_document_name"
+            ),
+        },
+    )
 
-    if func_name == "get_document_context_for_summarization":
-        function_response = functions_map[func_name](
-            st.session_state["selected_document_name"]
-        )
-    else:
-        function_response = functions_map[func_name](**func_args)
-
-    return str(function_response)
+    return agent_response.json()["response"]
 
 
-def llm_call(prompt: str) -> str:
-    llm_response = requests.post(llm_url + "/generate", json={"prompt": prompt})
-    llm_response_str = llm_response.json()["response"]
+def stream_response(prompt: str) -> str:
+    # Render the tokens as they arrive, a function call is replaced by the
+    # final response of the tool loop
+    placeholder = st.empty()
+    with placeholder:
+        llm_response = st.write_stream(llm_call_stream(prompt))
 
-    return llm_response_str
+    if not check_function_call(llm_response):
+        return llm_response
 
+    with placeholder:
+        with st.spinner("Looking through the documents..."):
+            llm_response = agent_resume(llm_response)
 
-def generate_response(prompt: str):
-    # Simulate a POST request to a backend that processes the user input
-    llm_response = llm_call(prompt)
-    next_llm_prompt = function_call(llm_response)
-
-    if next_llm_prompt is not None:
-        return generate_response(next_llm_prompt)
+    placeholder.markdown(llm_response)
 
     return llm_response
 
@@ -105,23 +170,27 @@ with supplementary_container:
                 # Attempt to display a file preview based on the file type
                 try:
                     if uploaded_file.type == "application/pdf":
-                        pdf = pdfium.PdfDocument(uploaded_file)
-                        upload_file(uploaded_file)
+                        upload = upload_once(uploaded_file)
 
                         # Use the first page for preview
-                        page = pdf[0]  # 0 is the first page
-                        image = page.render(scale=4).to_pil()
+                        image = render_preview(uploaded_file.getvalue())
 
                         # Display the image
                         st.image(
                             image, caption=uploaded_file.name, use_column_width=True
                         )
 
-                        # Create a button for selecting the document
-                        if st.button(f"Select {uploaded_file.name}"):
-                            st.session_state["selected_document_name"] = (
-                                uploaded_file.name
-                            )
+                        if upload["error"] is not None:
+                            st.error(f"Could not add the document: {upload['error']}")
+                        else:
+                            if upload["name"] != uploaded_file.name:
+                                st.write(f"Same contents as {upload['name']}")
+
+                            # Create a button for selecting the document
+                            if st.button(f"Select {uploaded_file.name}"):
+                                st.session_state["selected_document_name"] = (
+                                    upload["name"]
+                                )
 
                     else:
                         st.write("Preview not available for this file type.")
@@ -162,7 +231,6 @@ with chat_container:
 
         # Display assistant response in chat message container
         with st.chat_message("assistant"):
-            response = str(generate_response(prompt))
-            st.markdown(response)
+            response = str(stream_response(prompt))
             # Add assistant response to chat history
             st.session_state.messages.append({"role": "assistant", "content": response})
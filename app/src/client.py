@@ -0,0 +1,80 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+import requests
+import os
+
+
+LLM_URL = os.environ.get("LLM_URL", "http://llm_app:8001")
+RETRIEVAL_URL = os.environ.get("RETRIEVAL_URL", "http://retrieval_app:8002")
+
+# (connect, read) timeouts in seconds, the read timeout of a stream applies
+# to the wait for every next chunk
+DEFAULT_TIMEOUT = (3.05, 30.0)
+ENDPOINT_TIMEOUTS = {
+    "/generate": (3.05, 300.0),
+    "/generate_stream": (3.05, 120.0),
+    "/agent/resume": (3.05, 600.0),
+    "/add_document": (3.05, 120.0),
+    "/get_document": (3.05, 60.0),
+    "/search": (3.05, 30.0),
+    "/search_batch": (3.05, 300.0),
+    "/search_similar": (3.05, 30.0),
+    "/reset": (3.05, 30.0),
+}
+
+# Only the failures after which the request was surely not processed are
+# retried: refused connections and "busy" answers. A read timeout is not
+# retried, a generation could be run twice otherwise.
+RETRY_STATUSES = (429, 502, 503)
+
+
+def endpoint_timeout(endpoint: str) -> tuple[float, float]:
+    return ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+
+
+class ServiceClient:
+    """Keep-alive connections to one service, shared by all script runs"""
+
+    def __init__(
+        self,
+        base_url: str,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        pool_size: int = 16,
+    ):
+        self.base_url = base_url
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None,
+            backoff_factor=backoff_factor,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method: str, endpoint: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", endpoint_timeout(endpoint))
+        response = self.session.request(method, self.base_url + endpoint, **kwargs)
+        response.raise_for_status()
+
+        return response
+
+    def get(self, endpoint: str, **kwargs) -> requests.Response:
+        return self.request("GET", endpoint, **kwargs)
+
+    def post(self, endpoint: str, **kwargs) -> requests.Response:
+        return self.request("POST", endpoint, **kwargs)
+
+
+llm = ServiceClient(LLM_URL)
+retrieval = ServiceClient(RETRIEVAL_URL)
@@ -1,29 +1,112 @@
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from src.model import GenerativeModel
+from src.model import DEFAULT_SESSION, GenerativeModel
+from src.agent import Agent, ToolExecutor
+from typing import Iterator
+import json
+import os
 
 app = FastAPI(title="LLM", description="LLM Interface")
 
-llm = GenerativeModel()
+llm = GenerativeModel(
+    max_batch_size=int(os.environ.get("GENERATION_MAX_BATCH_SIZE", 1)),
+    max_wait_ms=float(os.environ.get("GENERATION_MAX_WAIT_MS", 10)),
+    max_sessions=int(os.environ.get("MAX_SESSIONS", 32)),
+    session_ttl_seconds=float(os.environ.get("SESSION_TTL_SECONDS", 1800)),
+    max_cached_tokens=int(os.environ.get("MAX_CACHED_TOKENS", 32768)),
+    token_budget=int(os.environ.get("CONTEXT_TOKEN_BUDGET", 6144)),
+    constrained_function_calls=bool(
+        int(os.environ.get("CONSTRAINED_FUNCTION_CALLS", 0))
+    ),
+    stream_timeout_seconds=float(os.environ.get("STREAM_TIMEOUT_SECONDS", 120)),
+)
+agent = Agent(
+    llm,
+    ToolExecutor(os.environ.get("RETRIEVAL_URL", "http://retrieval_app:8002")),
+    max_steps=int(os.environ.get("AGENT_MAX_STEPS", 5)),
+)
 
 
 class InputData(BaseModel):
     prompt: str
+    session_id: str = DEFAULT_SESSION
+
+
+class ResetData(BaseModel):
+    session_id: str = DEFAULT_SESSION
+
+
+class AgentInput(InputData):
+    selected_document_name: str | None = None
+
+
+class AgentResumeInput(BaseModel):
+    # a response of the model that may contain function calls
+    response: str
+    session_id: str = DEFAULT_SESSION
+    selected_document_name: str | None = None
+
+
+class AgentOutput(BaseModel):
+    response: str
+    steps: int
+    tool_calls: list[dict]
 
 
 class OutputData(BaseModel):
     response: str
+    # function calls parsed from the response during generation
+    function_calls: list[dict] = []
 
 
 @app.post("/generate", response_model=OutputData)
 def generate(input_data: InputData):
     prompt = input_data.prompt
 
-    response = llm.generate_response(prompt)
+    turn = llm.generate_turn(prompt, input_data.session_id)
+
+    return OutputData(response=turn.response, function_calls=turn.function_calls)
+
+
+def to_server_sent_events(pieces: Iterator[str]) -> Iterator[str]:
+    for piece in pieces:
+        yield f"data: {json.dumps(piece)}\n\n"
+
+    yield "event: done\ndata: {}\n\n"
+
+
+@app.post("/generate_stream")
+def generate_stream(input_data: InputData):
+    pieces = llm.generate_stream(input_data.prompt, input_data.session_id)
+
+    return StreamingResponse(
+        to_server_sent_events(pieces), media_type="text/event-stream"
+    )
+
+
+@app.post("/agent", response_model=AgentOutput)
+def run_agent(agent_input: AgentInput):
+    result = agent.run(
+        agent_input.prompt,
+        agent_input.session_id,
+        agent_input.selected_document_name,
+    )
+
+    return AgentOutput(**result.__dict__)
+
+
+@app.post("/agent/resume", response_model=AgentOutput)
+def resume_agent(agent_input: AgentResumeInput):
+    result = agent.resume(
+        agent_input.response,
+        agent_input.session_id,
+        agent_input.selected_document_name,
+    )
 
-    return OutputData(response=response)
+    return AgentOutput(**result.__dict__)
 
 
 @app.post("/reset")
-def reset():
-    llm.reset()
\ No newline at end of file
+def reset(reset_data: ResetData | None = None):
+    llm.reset(reset_data.session_id if reset_data is not None else DEFAULT_SESSION)
\ No newline at end of file
@@ -0,0 +1,129 @@
+from llm.src.function_call import parse_function_calls
+from llm.src.model import Turn
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import requests
+
+
+class ToolExecutor:
+    """Runs the tools of `llm.src.functions` against the retrieval service"""
+
+    def __init__(self, retrieval_url: str, timeout: float = 60.0, max_workers: int = 4):
+        self.retrieval_url = retrieval_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tool"
+        )
+
+    def __post(self, endpoint: str, payload: dict):
+        response = self.session.post(
+            self.retrieval_url + endpoint, json=payload, timeout=self.timeout
+        )
+        response.raise_for_status()
+
+        return response.json()
+
+    def run(self, call: dict, selected_document_name: str | None = None) -> str:
+        if "error" in call:
+            return call["error"]
+
+        name, arguments = call["name"], call["arguments"]
+        try:
+            if name == "get_document_context_for_summarization":
+                if selected_document_name is None:
+                    return "No document is selected."
+
+                result = self.__post(
+                    "/get_document", {"name": selected_document_name}
+                )
+            elif name == "search_similar_documents_in_the_database":
+                result = self.__post(
+                    "/search",
+                    {
+                        "prompt": arguments["prompt"],
+                        "top_k": int(arguments.get("top_k", 1)),
+                    },
+                )
+            elif name == "request_list_of_documents_names":
+                result = self.__post(
+                    "/search_similar", {"fragment": arguments["fragment"]}
+                )
+            else:
+                return f"There is no function {name}."
+        except (KeyError, ValueError) as e:
+            return f"Invalid arguments for {name}: {e}"
+        except requests.RequestException as e:
+            return f"The call of {name} has failed: {e}"
+
+        return str(result)
+
+    def run_many(
+        self, calls: list[dict], selected_document_name: str | None = None
+    ) -> list[str]:
+        """Runs independent calls of one turn concurrently, keeping their order"""
+        if len(calls) == 1:
+            return [self.run(calls[0], selected_document_name)]
+
+        return list(
+            self.executor.map(
+                lambda call: self.run(call, selected_document_name), calls
+            )
+        )
+
+
+@dataclass
+class AgentResult:
+    response: str
+    steps: int = 0
+    tool_calls: list[dict] = field(default_factory=list)
+
+
+class Agent:
+    """Runs the tool loop in the LLM service.
+
+    Tool results are sent back to the model as the next user turn, the way the
+    chat application used to do it, until the model answers without a function
+    call or `max_steps` tool rounds were made.
+    """
+
+    def __init__(self, model, tools: ToolExecutor, max_steps: int = 5):
+        self.model = model
+        self.tools = tools
+        self.max_steps = max_steps
+
+    def run(
+        self,
+        prompt: str,
+        session_id: str,
+        selected_document_name: str | None = None,
+    ) -> AgentResult:
+        turn = self.model.generate_turn(prompt, session_id)
+
+        return self.__loop(turn, session_id, selected_document_name)
+
+    def resume(
+        self,
+        response: str,
+        session_id: str,
+        selected_document_name: str | None = None,
+    ) -> AgentResult:
+        """Continues the loop from a response that was already generated"""
+        turn = Turn(response, parse_function_calls(response))
+
+        return self.__loop(turn, session_id, selected_document_name)
+
+    def __loop(
+        self, turn: Turn, session_id: str, selected_document_name: str | None
+    ) -> AgentResult:
+        result = AgentResult(turn.response)
+
+        while result.steps < self.max_steps and len(turn.function_calls) > 0:
+            outputs = self.tools.run_many(turn.function_calls, selected_document_name)
+            result.tool_calls.extend(turn.function_calls)
+            result.steps += 1
+
+            turn = self.model.generate_turn("\n\n".join(outputs), session_id)
+            result.response = turn.response
+
+        return result
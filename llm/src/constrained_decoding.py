@@ -0,0 +1,260 @@
+from llm.src.function_call import FUNCTION_CALL_TAG
+from transformers import LogitsProcessor
+import torch
+
+
+INVALID, PREFIX, COMPLETE = range(3)
+
+
+class _Incomplete(Exception):
+    pass
+
+
+class _Invalid(Exception):
+    pass
+
+
+class _CallParser:
+    """Recursive descent over the text of one call, which may be cut anywhere"""
+
+    def __init__(self, text: str, functions: dict[str, dict]):
+        self.text = text
+        self.position = 0
+        self.functions = functions
+
+    def peek(self) -> str:
+        if self.position >= len(self.text):
+            raise _Incomplete
+
+        return self.text[self.position]
+
+    def whitespace(self) -> None:
+        while self.position < len(self.text) and self.text[self.position] in " \t\n\r":
+            self.position += 1
+
+    def choice(self, options: list[str]) -> str:
+        rest = self.text[self.position :]
+        for option in options:
+            if rest.startswith(option):
+                self.position += len(option)
+                return option
+
+        if any(option.startswith(rest) for option in options):
+            raise _Incomplete
+
+        raise _Invalid
+
+    def literal(self, expected: str) -> None:
+        self.choice([expected])
+
+    def key(self, names) -> str:
+        return self.choice([f'"{name}"' for name in names])[1:-1]
+
+    def call(self) -> None:
+        self.whitespace()
+        self.literal("{")
+        self.whitespace()
+        self.literal('"name"')
+        self.whitespace()
+        self.literal(":")
+        self.whitespace()
+        name = self.key(self.functions)
+        self.whitespace()
+        self.literal(",")
+        self.whitespace()
+        self.literal('"arguments"')
+        self.whitespace()
+        self.literal(":")
+        self.whitespace()
+        self.arguments(self.functions[name])
+        self.whitespace()
+        self.literal("}")
+
+    def arguments(self, parameters: dict) -> None:
+        properties = parameters.get("properties", {})
+        required = set(parameters.get("required", []))
+        seen = set()
+
+        self.literal("{")
+        self.whitespace()
+        if self.peek() == "}":
+            if not required <= seen:
+                raise _Invalid
+            self.position += 1
+            return
+
+        while True:
+            name = self.key([name for name in properties if name not in seen])
+            self.whitespace()
+            self.literal(":")
+            self.whitespace()
+            self.value(properties[name])
+            seen.add(name)
+            self.whitespace()
+
+            char = self.peek()
+            if char == ",":
+                self.position += 1
+                self.whitespace()
+            elif char == "}" and required <= seen:
+                self.position += 1
+                return
+            else:
+                raise _Invalid
+
+    def value(self, schema: dict) -> None:
+        if "enum" in schema:
+            self.choice([f'"{option}"' for option in schema["enum"]])
+        elif schema.get("type") == "integer":
+            self.number(fraction=False)
+        elif schema.get("type") == "number":
+            self.number(fraction=True)
+        elif schema.get("type") == "boolean":
+            self.choice(["true", "false"])
+        else:
+            # parameters without a known type are passed as strings
+            self.string()
+
+    def digits(self) -> None:
+        if not self.peek().isdigit():
+            raise _Invalid
+
+        while self.peek().isdigit():
+            self.position += 1
+
+    def number(self, fraction: bool) -> None:
+        if self.peek() == "-":
+            self.position += 1
+
+        if self.peek() == "0":
+            self.position += 1
+        else:
+            self.digits()
+
+        if fraction and self.peek() == ".":
+            self.position += 1
+            self.digits()
+
+        if fraction and self.peek() in "eE":
+            self.position += 1
+            if self.peek() in "+-":
+                self.position += 1
+            self.digits()
+
+    def string(self) -> None:
+        self.literal('"')
+
+        while True:
+            char = self.peek()
+            self.position += 1
+
+            if char == '"':
+                return
+            elif char == "\\":
+                escaped = self.peek()
+                self.position += 1
+                if escaped == "u":
+                    for _ in range(4):
+                        if self.peek() not in "0123456789abcdefABCDEF":
+                            raise _Invalid
+                        self.position += 1
+                elif escaped not in '"\\/bfnrt':
+                    raise _Invalid
+            elif char < " ":
+                raise _Invalid
+
+
+class ToolCallGrammar:
+    """The JSON a function call may consist of, built from the function schemas.
+
+    A call is `{"name": <known function>, "arguments": {...}}` where the
+    arguments are an object with the parameters of that function, each one at
+    most once, the required ones included, with values of the declared types.
+    """
+
+    def __init__(self, functions: list[dict]):
+        self.functions = {function["name"]: function["parameters"] for function in functions}
+
+    def check(self, text: str) -> int:
+        """Returns INVALID, PREFIX of a valid call or COMPLETE call"""
+        parser = _CallParser(text, self.functions)
+        try:
+            parser.call()
+        except _Incomplete:
+            return PREFIX
+        except _Invalid:
+            return INVALID
+
+        return COMPLETE
+
+
+def token_strings(tokenizer) -> list[str]:
+    """The text of every token of the vocabulary, computed once per tokenizer"""
+    return [tokenizer.decode([token_id]) for token_id in range(len(tokenizer))]
+
+
+class ToolCallLogitsProcessor(LogitsProcessor):
+    """Masks the tokens that would break the function call being generated.
+
+    Decoding is left alone until `<functioncall>` has been emitted. From then
+    on and until the call is complete, the candidates are tried in the order of
+    their scores, `top_k` at a time, and only those that keep the call text a
+    valid prefix of the grammar can be sampled.
+    """
+
+    def __init__(
+        self,
+        grammar: ToolCallGrammar,
+        tokenizer,
+        vocabulary: list[str],
+        prompt_length: int,
+        top_k: int = 32,
+    ):
+        self.grammar = grammar
+        self.tokenizer = tokenizer
+        self.vocabulary = vocabulary
+        self.prompt_length = prompt_length
+        self.top_k = top_k
+
+    def __allowed(self, call_text: str, scores: torch.FloatTensor) -> list[int]:
+        candidates = torch.argsort(scores, descending=True).tolist()
+
+        for start in range(0, len(candidates), self.top_k):
+            allowed = [
+                token_id
+                for token_id in candidates[start : start + self.top_k]
+                # special tokens decode to nothing and would end the call
+                if token_id < len(self.vocabulary)
+                and self.vocabulary[token_id]
+                and self.grammar.check(call_text + self.vocabulary[token_id])
+                != INVALID
+            ]
+            if allowed:
+                return allowed
+
+        return []
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        for row in range(input_ids.shape[0]):
+            text = self.tokenizer.decode(
+                input_ids[row, self.prompt_length :], skip_special_tokens=True
+            )
+            tag = text.rfind(FUNCTION_CALL_TAG)
+            if tag == -1:
+                continue
+
+            call_text = text[tag + len(FUNCTION_CALL_TAG) :]
+            if self.grammar.check(call_text) != PREFIX:
+                continue
+
+            allowed = self.__allowed(call_text, scores[row])
+            if not allowed:
+                continue
+
+            mask = torch.full_like(scores[row], float("-inf"))
+            mask[allowed] = 0
+            scores[row] = scores[row] + mask
+
+        return scores
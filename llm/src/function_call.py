@@ -0,0 +1,188 @@
+from transformers import StoppingCriteria
+import torch
+import json
+
+
+FUNCTION_CALL_TAG = "<functioncall>"
+PARSING_ERROR = "An error during function call parsing has occurred."
+# longest whitespace between the calls of one turn
+MAX_CALL_GAP = 16
+
+
+def parse_arguments(arguments) -> dict:
+    """The prompt asks for an arguments object, a JSON string is accepted too"""
+    if isinstance(arguments, str):
+        arguments = json.loads(arguments) if arguments.strip() else {}
+
+    if not isinstance(arguments, dict):
+        raise ValueError("Function call arguments must be a JSON object.")
+
+    return arguments
+
+
+def parse_call(call_json: str) -> dict:
+    try:
+        call = json.loads(call_json)
+        return {"name": call["name"], "arguments": parse_arguments(call.get("arguments"))}
+    except (ValueError, KeyError, TypeError):
+        return {"error": PARSING_ERROR}
+
+
+class FunctionCallDetector:
+    """Scans text incrementally for `<functioncall> {...}` calls.
+
+    Every character is looked at once: the detector tracks the nesting depth of
+    the JSON object and whether it is inside a string, so a call is known to be
+    complete the moment its closing brace arrives. Calls of one turn may follow
+    each other separated by at most `MAX_CALL_GAP` whitespace characters,
+    `finished` is set when the text after a complete call is anything else.
+    """
+
+    SEARCHING, BEFORE_OBJECT, IN_OBJECT, AFTER_CALL = range(4)
+
+    def __init__(self):
+        self.text = ""
+        self.position = 0
+        self.state = self.SEARCHING
+
+        self.calls: list[dict] = []
+        self.finished = False
+
+        self.object_start = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, piece: str) -> bool:
+        """Consumes a piece of text, returns whether generation can stop"""
+        self.text += piece
+
+        handlers = {
+            self.SEARCHING: self.__search,
+            self.BEFORE_OBJECT: self.__before_object,
+            self.IN_OBJECT: self.__in_object,
+            self.AFTER_CALL: self.__after_call,
+        }
+        while self.position < len(self.text):
+            # a handler returns False when it needs more text to go on
+            if not handlers[self.state]():
+                break
+
+        return self.finished
+
+    def close(self) -> list[dict]:
+        """Ends the text, an unfinished call is reported as an error"""
+        if self.state in (self.BEFORE_OBJECT, self.IN_OBJECT):
+            self.calls.append({"error": PARSING_ERROR})
+            self.state = self.SEARCHING
+
+        return self.calls
+
+    def __search(self) -> bool:
+        found = self.text.find(FUNCTION_CALL_TAG, self.position)
+        if found == -1:
+            # the tag may still be completed by the next piece
+            self.position = max(
+                self.position, len(self.text) - len(FUNCTION_CALL_TAG) + 1
+            )
+            return False
+
+        self.position = found + len(FUNCTION_CALL_TAG)
+        self.state = self.BEFORE_OBJECT
+        return True
+
+    def __before_object(self) -> bool:
+        char = self.text[self.position]
+        if char == "{":
+            self.object_start = self.position
+            self.depth = 0
+            self.in_string = False
+            self.escaped = False
+            # the brace itself is counted by the object scanner
+            self.state = self.IN_OBJECT
+            return True
+        elif not char.isspace():
+            self.calls.append({"error": PARSING_ERROR})
+            self.state = self.SEARCHING
+            return True
+
+        self.position += 1
+        return True
+
+    def __in_object(self) -> bool:
+        char = self.text[self.position]
+        self.position += 1
+
+        if self.in_string:
+            if self.escaped:
+                self.escaped = False
+            elif char == "\\":
+                self.escaped = True
+            elif char == '"':
+                self.in_string = False
+        elif char == '"':
+            self.in_string = True
+        elif char == "{":
+            self.depth += 1
+        elif char == "}":
+            self.depth -= 1
+            if self.depth == 0:
+                self.calls.append(parse_call(self.text[self.object_start : self.position]))
+                self.state = self.AFTER_CALL
+
+        return True
+
+    def __after_call(self) -> bool:
+        """Returns whether scanning can go on with the text there is"""
+        after = self.text[self.position :]
+        rest = after.lstrip()
+        if rest.startswith(FUNCTION_CALL_TAG):
+            self.state = self.SEARCHING
+            return True
+
+        gap = len(after) - len(rest)
+        if gap <= MAX_CALL_GAP and (rest == "" or FUNCTION_CALL_TAG.startswith(rest)):
+            # another call may follow, wait for more text
+            return False
+
+        self.finished = True
+        self.state = self.SEARCHING
+        return True
+
+
+def parse_function_calls(text: str) -> list[dict]:
+    """Extracts every `<functioncall> {"name": ..., "arguments": ...}` of a response.
+
+    A call that can not be decoded is returned as {"error": ...}.
+    """
+    detector = FunctionCallDetector()
+    detector.feed(text)
+
+    return detector.close()
+
+
+class FunctionCallStoppingCriteria(StoppingCriteria):
+    """Stops a sequence as soon as the function call it emitted is complete.
+
+    Only the newly generated tokens of every row are decoded and fed to the
+    row's detector, so each step costs a constant amount of work.
+    """
+
+    def __init__(self, tokenizer, prompt_length: int, batch_size: int = 1):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.seen_length = prompt_length
+        self.detectors = [FunctionCallDetector() for _ in range(batch_size)]
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        new_ids = input_ids[:, self.seen_length :].tolist()
+        self.seen_length = input_ids.shape[1]
+
+        done = [
+            detector.feed(self.tokenizer.decode(row_ids, skip_special_tokens=True))
+            for detector, row_ids in zip(self.detectors, new_ids)
+        ]
+
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,120 @@
+from transformers import DynamicCache
+import torch
+import copy
+
+
+class PromptPrefix:
+    """A conversation start, e.g. the system prompt, prefilled once and shared"""
+
+    def __init__(self, model, tokenizer, messages: list[dict]):
+        self.model = model
+        self.tokenizer = tokenizer
+
+        self.text = tokenizer.apply_chat_template(messages, tokenize=False)
+        self.input_ids = self.tokenize(self.text)
+
+        with torch.no_grad():
+            self.past_key_values = model(
+                self.input_ids, past_key_values=DynamicCache(), use_cache=True
+            ).past_key_values
+
+    def tokenize(self, text: str) -> torch.Tensor:
+        return self.tokenizer(
+            text, add_special_tokens=False, return_tensors="pt"
+        ).input_ids.to(self.model.device)
+
+
+class ConversationCache:
+    """Past key-values of a conversation and the token ids they were computed for.
+
+    Every conversation starts from a copy of the shared prefix cache. For a new
+    turn only the text the chat template adds for it is tokenized, and
+    generation prefills only the tokens the cache does not cover yet.
+    """
+
+    def __init__(self, prefix: PromptPrefix):
+        self.prefix = prefix
+        self.tokenizer = prefix.tokenizer
+        self.end_of_turn_id = self.tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        self.terminators = {self.tokenizer.eos_token_id, self.end_of_turn_id}
+
+        self.reset()
+
+    def reset(self) -> None:
+        self.input_ids = self.prefix.input_ids
+        self.past_key_values = copy.deepcopy(self.prefix.past_key_values)
+        self.valid = True
+
+    def invalidate(self) -> None:
+        """Marks the cache stale, e.g. after earlier turns were dropped"""
+        self.valid = False
+
+    def release(self) -> None:
+        """Frees the cached keys and values, the next turn prefills them again"""
+        self.input_ids = self.prefix.input_ids
+        self.past_key_values = None
+        self.valid = False
+
+    @property
+    def num_tokens(self) -> int:
+        """Number of tokens the cached keys and values are held for"""
+        if self.past_key_values is None:
+            return 0
+
+        return self.past_key_values.get_seq_length()
+
+    def __restart(self, text: str) -> torch.Tensor:
+        """Tokenizes the whole conversation, keeping only the prefix cache"""
+        self.reset()
+
+        if not text.startswith(self.prefix.text):
+            self.input_ids = self.prefix.tokenize(text)
+            self.past_key_values = DynamicCache()
+            return self.input_ids
+
+        return torch.cat(
+            [self.input_ids, self.prefix.tokenize(text[len(self.prefix.text) :])],
+            dim=-1,
+        )
+
+    def extend(self, history: list[dict], new_messages: list[dict]) -> torch.Tensor:
+        """Returns the input ids of the conversation with the new messages and a
+        generation prompt appended, tokenizing only the appended text"""
+        text = self.tokenizer.apply_chat_template(
+            history + new_messages, tokenize=False, add_generation_prompt=True
+        )
+        if not self.valid:
+            return self.__restart(text)
+
+        previous_text = self.tokenizer.apply_chat_template(history, tokenize=False)
+        if not text.startswith(previous_text):
+            # the template rendered the earlier turns differently, start over
+            return self.__restart(text)
+
+        new_ids = self.prefix.tokenize(text[len(previous_text) :])
+
+        return torch.cat([self.input_ids, new_ids], dim=-1)
+
+    def commit(
+        self,
+        sequence: torch.Tensor,
+        prompt_length: int,
+        past_key_values: DynamicCache,
+    ) -> None:
+        """Keeps the cache produced by a generation for the next turn.
+
+        The response is closed with an end-of-turn token the same way the chat
+        template renders it. The cache does not hold the last generated token, so
+        it always covers a prefix of the kept input ids.
+        """
+        response_ids = sequence[0, prompt_length:].tolist()
+        while response_ids and response_ids[-1] in self.terminators:
+            response_ids.pop()
+
+        closing_ids = torch.tensor(
+            [response_ids + [self.end_of_turn_id]],
+            dtype=sequence.dtype,
+            device=sequence.device,
+        )
+        self.input_ids = torch.cat([sequence[:, :prompt_length], closing_ids], dim=-1)
+        self.past_key_values = past_key_values
@@ -1,16 +1,78 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
 from llm.src.prompt import SYSTEM_PROMPT
+from llm.src.functions import functions_list
+from llm.src.constrained_decoding import (
+    ToolCallGrammar,
+    ToolCallLogitsProcessor,
+    token_strings,
+)
+from llm.src.kv_cache import ConversationCache, PromptPrefix
+from llm.src.scheduler import BatchScheduler
+from llm.src.sessions import ContextCompactor, Session, SessionStore
+from llm.src.function_call import FunctionCallStoppingCriteria, parse_function_calls
+from dataclasses import dataclass, field
+from threading import Event, Thread
+from typing import Iterator
+import queue
 import torch
 
 
-class GenerativeModel:
+DEFAULT_SESSION = "default"
+
+
+@dataclass
+class Turn:
+    response: str
+    # calls parsed from the response, {"name": ..., "arguments": {...}} each
+    function_calls: list[dict] = field(default_factory=list)
+
+
+class CancellationStoppingCriteria(StoppingCriteria):
+    """Stops the generation once `cancelled` is set, e.g. when its client is gone"""
+
     def __init__(self) -> None:
-        self.__model_id = "mzbac/llama-3-8B-Instruct-function-calling-v0.2"
+        self.cancelled = Event()
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        return torch.full(
+            (input_ids.shape[0],),
+            self.cancelled.is_set(),
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+class GenerativeModel:
+    def __init__(
+        self,
+        model_id: str = "mzbac/llama-3-8B-Instruct-function-calling-v0.2",
+        max_batch_size: int = 1,
+        max_wait_ms: float = 10.0,
+        max_sessions: int = 32,
+        session_ttl_seconds: float = 1800.0,
+        max_cached_tokens: int = 32768,
+        token_budget: int = 6144,
+        constrained_function_calls: bool = False,
+        stream_timeout_seconds: float = 120.0,
+    ) -> None:
+        self.__model_id = model_id
+        # longest wait for the next piece of a streamed response
+        self.stream_timeout_seconds = stream_timeout_seconds
 
         self.tokenizer = AutoTokenizer.from_pretrained(self.__model_id)
         self.model = AutoModelForCausalLM.from_pretrained(
             self.__model_id,
-            torch_dtype=torch.float16,
+            # half precision is slow or unsupported on CPU
+            torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
             device_map="auto",
         )
 
@@ -19,45 +81,238 @@ class GenerativeModel:
             self.tokenizer.convert_tokens_to_ids("<|eot_id|>"),
         ]
 
-        self.history = [
-            {
-                "role": "system",
-                "content": SYSTEM_PROMPT,
-            }
-        ]
+        self.system_message = {
+            "role": "system",
+            "content": SYSTEM_PROMPT,
+        }
+        # function call JSON is restricted to the schemas of the known functions
+        self.grammar = None
+        self.vocabulary = None
+        if constrained_function_calls:
+            self.grammar = ToolCallGrammar(functions_list)
+            self.vocabulary = token_strings(self.tokenizer)
+
+        self.compactor = ContextCompactor(self.tokenizer, token_budget=token_budget)
+        self.system_prompt_tokens = self.compactor.count(SYSTEM_PROMPT)
+
+        # Concurrent requests are batched together when the batch size allows it.
+        # Batched prompts are prefilled in full, the per-conversation KV cache
+        # is only kept for unbatched generation.
+        self.scheduler = None
+        self.system_prefix = None
+        if max_batch_size > 1:
+            self.scheduler = BatchScheduler(
+                self.model,
+                self.tokenizer,
+                max_batch_size=max_batch_size,
+                max_wait_ms=max_wait_ms,
+                make_generation_kwargs=self.__decoding_kwargs,
+                eos_token_id=self.terminators,
+                do_sample=True,
+                temperature=0.1,
+            )
+        else:
+            # the system prompt is prefilled once and shared by all sessions
+            self.system_prefix = PromptPrefix(
+                self.model, self.tokenizer, [self.system_message]
+            )
+
+        self.sessions = SessionStore(
+            self.__create_session,
+            max_sessions=max_sessions,
+            ttl_seconds=session_ttl_seconds,
+            max_cached_tokens=max_cached_tokens,
+        )
+
+    def __create_session(self, session_id: str) -> Session:
+        cache = None
+        if self.system_prefix is not None:
+            # keeps the prefilled conversation between turns
+            cache = ConversationCache(self.system_prefix)
+
+        return Session(
+            id=session_id,
+            history=[self.system_message],
+            cache=cache,
+            token_counts=[self.system_prompt_tokens],
+        )
+
+    def __append_message(self, session: Session, message: dict) -> None:
+        session.history.append(message)
+        session.token_counts.append(self.compactor.count(message["content"]))
+
+    def __prepare_inputs(self, session: Session, prompt: str) -> torch.Tensor:
+        user_message = {"role": "user", "content": prompt}
+
+        # Keep the prompt within the token budget, the cached prefix is lost
+        # when earlier turns are changed
+        self.__append_message(session, user_message)
+        if self.compactor.compact(session) and session.cache is not None:
+            session.cache.invalidate()
+        history = session.history[:-1]
 
-    def generate_response(self, prompt: str) -> str:
-        # If the last response was a function call, execute it and return the result
-        self.history.append({"role": "user", "content": prompt})
+        if session.cache is not None:
+            # Apply chat template, only the new turn gets tokenized
+            return session.cache.extend(history, [user_message])
 
         # Tokenize input and apply chat template
-        input_ids = self.tokenizer.apply_chat_template(
-            self.history, add_generation_prompt=True, return_tensors="pt"
+        return self.tokenizer.apply_chat_template(
+            session.history, add_generation_prompt=True, return_tensors="pt"
         ).to(self.model.device)
 
-        # Generate the response from the model
-        outputs = self.model.generate(
-            input_ids,
+    def __decoding_kwargs(self, prompt_length: int, batch_size: int = 1) -> dict:
+        # decoding stops as soon as an emitted function call is complete
+        kwargs = dict(
+            stopping_criteria=StoppingCriteriaList(
+                [FunctionCallStoppingCriteria(self.tokenizer, prompt_length, batch_size)]
+            )
+        )
+        if self.grammar is not None:
+            kwargs["logits_processor"] = LogitsProcessorList(
+                [
+                    ToolCallLogitsProcessor(
+                        self.grammar, self.tokenizer, self.vocabulary, prompt_length
+                    )
+                ]
+            )
+
+        return kwargs
+
+    def __generation_kwargs(self, session: Session, input_ids: torch.Tensor) -> dict:
+        kwargs = dict(
+            attention_mask=torch.ones_like(input_ids),
+            return_dict_in_generate=True,
             max_new_tokens=256,
             eos_token_id=self.terminators,
             do_sample=True,
             temperature=0.1,
+            **self.__decoding_kwargs(input_ids.shape[1]),
         )
+        if session.cache is not None:
+            kwargs["past_key_values"] = session.cache.past_key_values
+
+        return kwargs
+
+    def __finish_turn(
+        self, session: Session, input_ids: torch.Tensor, sequences, past_key_values
+    ) -> str:
+        if session.cache is not None:
+            session.cache.commit(sequences, input_ids.shape[1], past_key_values)
 
         # Decode the response
         llm_response = self.tokenizer.decode(
-            outputs[0, input_ids.shape[1] :], skip_special_tokens=True
+            sequences[0, input_ids.shape[1] :], skip_special_tokens=True
         ).strip()
 
         # Add interaction to conversation history
-        self.history.append({"role": "assistant", "content": llm_response})
+        self.__append_message(session, {"role": "assistant", "content": llm_response})
 
         return llm_response
 
-    def reset(self):
-        self.history = [
-            {
-                "role": "system",
-                "content": SYSTEM_PROMPT,
-            }
-        ]
+    def generate_response(self, prompt: str, session_id: str = DEFAULT_SESSION) -> str:
+        return self.generate_turn(prompt, session_id).response
+
+    def generate_turn(self, prompt: str, session_id: str = DEFAULT_SESSION) -> Turn:
+        """Generates a response together with the function calls parsed from it"""
+        session = self.sessions.get(session_id)
+
+        with session.lock:
+            input_ids = self.__prepare_inputs(session, prompt)
+
+            # Generate the response from the model
+            if self.scheduler is not None:
+                generated_ids = self.scheduler.generate(input_ids[0].tolist())
+                sequences = torch.cat(
+                    [
+                        input_ids,
+                        torch.tensor(
+                            [generated_ids],
+                            dtype=input_ids.dtype,
+                            device=input_ids.device,
+                        ),
+                    ],
+                    dim=-1,
+                )
+
+                response = self.__finish_turn(session, input_ids, sequences, None)
+            else:
+                try:
+                    outputs = self.model.generate(
+                        input_ids, **self.__generation_kwargs(session, input_ids)
+                    )
+                except Exception:
+                    if session.cache is not None:
+                        # the cached keys and values are extended in place
+                        session.cache.invalidate()
+                    raise
+
+                response = self.__finish_turn(
+                    session, input_ids, outputs.sequences, outputs.past_key_values
+                )
+
+        return Turn(response, parse_function_calls(response))
+
+    def generate_stream(
+        self, prompt: str, session_id: str = DEFAULT_SESSION
+    ) -> Iterator[str]:
+        """Yields pieces of the response text as soon as they are decoded"""
+        session = self.sessions.get(session_id)
+
+        with session.lock:
+            input_ids = self.__prepare_inputs(session, prompt)
+
+            streamer = TextIteratorStreamer(
+                self.tokenizer,
+                skip_prompt=True,
+                skip_special_tokens=True,
+                timeout=self.stream_timeout_seconds,
+            )
+            cancellation = CancellationStoppingCriteria()
+            kwargs = self.__generation_kwargs(session, input_ids)
+            kwargs["stopping_criteria"].append(cancellation)
+            result = {}
+
+            def generate():
+                try:
+                    result["outputs"] = self.model.generate(
+                        input_ids, streamer=streamer, **kwargs
+                    )
+                except Exception as e:
+                    result["error"] = e
+                    # the streamer only stops iterating when it is ended
+                    streamer.end()
+
+            generation = Thread(target=generate)
+            generation.start()
+
+            finished = False
+            try:
+                try:
+                    for piece in streamer:
+                        yield piece
+                except queue.Empty:
+                    raise TimeoutError(
+                        f"No response from the model within "
+                        f"{self.stream_timeout_seconds} seconds"
+                    )
+
+                generation.join()
+                if "error" in result:
+                    raise result["error"]
+
+                outputs = result["outputs"]
+                self.__finish_turn(
+                    session, input_ids, outputs.sequences, outputs.past_key_values
+                )
+                finished = True
+            finally:
+                if not finished:
+                    # the client is gone or the generation failed
+                    cancellation.cancelled.set()
+                    generation.join(timeout=self.stream_timeout_seconds)
+                    if session.cache is not None:
+                        # the generation has extended the cached keys and values
+                        session.cache.invalidate()
+
+    def reset(self, session_id: str = DEFAULT_SESSION):
+        self.sessions.reset(session_id)
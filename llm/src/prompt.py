@@ -1,9 +1,15 @@
 from llm.src.functions import functions_list
+import json
+
+# a call as the parser and the call grammar expect it, with an arguments object
+CALL_EXAMPLE = json.dumps(
+    {"name": "<function_name>", "arguments": {"<parameter_name>": "<value>"}}
+)
 
 SYSTEM_PROMPT = f"""
-You are an assistant that helps users manage and extract information from their documents. Use the following tools to assist users: {str(functions_list)}.
+You are an assistant that helps users manage and extract information from their documents. Use the following tools to assist users: {json.dumps(functions_list)}.
 
 When a user makes a request, consider what information they need. For document-specific queries, first ensure you understand the document's context by fetching its text if necessary. 
 For queries about document mentions or when you are asked a question, directly use the search function.
 
-For each function, use the following format to initiate a call: '<functioncall> {str({"name": "<function_name>", "arguments": "<arguments_json_string>"})}'."""
+For each function, use the following format to initiate a call: '<functioncall> {CALL_EXAMPLE}'."""
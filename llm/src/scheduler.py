@@ -0,0 +1,155 @@
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable
+import threading
+import queue
+import time
+import torch
+
+
+@dataclass
+class GenerationRequest:
+    input_ids: list[int]
+    max_new_tokens: int
+    future: Future = field(default_factory=Future)
+    submitted_at: float = field(default_factory=time.monotonic)
+
+
+class BatchScheduler:
+    """Groups concurrent generation requests into batched `generate` calls.
+
+    A background thread takes the first pending request, waits at most
+    `max_wait_ms` for more to arrive, left-pads up to `max_batch_size` prompts
+    into one batch and routes every generated sequence back to its caller.
+    Works with any causal LM and tokenizer, a tiny model on CPU included.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        make_generation_kwargs: Callable | None = None,
+        **generation_kwargs,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # called with the padded prompt length and the batch size, returns
+        # per-batch arguments such as stopping criteria
+        self.make_generation_kwargs = make_generation_kwargs
+        self.generation_kwargs = generation_kwargs
+
+        self.pad_token_id = (
+            tokenizer.pad_token_id
+            if tokenizer.pad_token_id is not None
+            else tokenizer.eos_token_id
+        )
+        eos_token_id = generation_kwargs.get("eos_token_id", tokenizer.eos_token_id)
+        self.terminators = set(
+            eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        )
+
+        self.batches = 0
+        self.requests = 0
+
+        self.queue: queue.Queue[GenerationRequest] = queue.Queue()
+        self.worker = threading.Thread(target=self.__loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, input_ids: list[int], max_new_tokens: int = 256) -> Future:
+        """Queues a prompt, the future resolves to the generated token ids"""
+        request = GenerationRequest(input_ids, max_new_tokens)
+        self.queue.put(request)
+
+        return request.future
+
+    def generate(self, input_ids: list[int], max_new_tokens: int = 256) -> list[int]:
+        return self.submit(input_ids, max_new_tokens).result()
+
+    def __collect(self) -> list[GenerationRequest]:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def __loop(self) -> None:
+        while True:
+            batch = self.__collect()
+
+            try:
+                generated = self.__run(batch)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            for request, generated_ids in zip(batch, generated):
+                request.future.set_result(generated_ids)
+
+    @torch.no_grad()
+    def __run(self, batch: list[GenerationRequest]) -> list[list[int]]:
+        prompt_length = max(len(request.input_ids) for request in batch)
+
+        # prompts are padded on the left so that generation continues all of them
+        input_ids = torch.full(
+            (len(batch), prompt_length), self.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((len(batch), prompt_length), dtype=torch.long)
+        for row, request in enumerate(batch):
+            input_ids[row, prompt_length - len(request.input_ids) :] = torch.tensor(
+                request.input_ids
+            )
+            attention_mask[row, prompt_length - len(request.input_ids) :] = 1
+
+        generation_kwargs = dict(self.generation_kwargs)
+        if self.make_generation_kwargs is not None:
+            generation_kwargs.update(
+                self.make_generation_kwargs(prompt_length, len(batch))
+            )
+
+        outputs = self.model.generate(
+            input_ids.to(self.model.device),
+            attention_mask=attention_mask.to(self.model.device),
+            pad_token_id=self.pad_token_id,
+            max_new_tokens=max(request.max_new_tokens for request in batch),
+            **generation_kwargs,
+        )
+
+        self.batches += 1
+        self.requests += len(batch)
+
+        generated = []
+        for row, request in enumerate(batch):
+            generated_ids = outputs[row, prompt_length:].tolist()
+            generated_ids = generated_ids[: request.max_new_tokens]
+
+            # finished rows are filled with padding until the longest one stops
+            for position, token_id in enumerate(generated_ids):
+                if token_id in self.terminators:
+                    generated_ids = generated_ids[: position + 1]
+                    break
+
+            generated.append(generated_ids)
+
+        return generated
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "pending": self.queue.qsize(),
+        }
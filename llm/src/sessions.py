@@ -0,0 +1,168 @@
+from llm.src.kv_cache import ConversationCache
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable
+import threading
+import time
+
+
+TRUNCATION_NOTE = " [...truncated]"
+
+
+@dataclass
+class Session:
+    id: str
+    # conversation messages, the first one is always the system prompt
+    history: list[dict]
+    cache: ConversationCache | None
+    # number of tokens of every message in the history
+    token_counts: list[int]
+    last_used: float = field(default_factory=time.monotonic)
+    # turns of one session are generated one at a time
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def reset(self) -> None:
+        del self.history[1:]
+        del self.token_counts[1:]
+
+        if self.cache is not None:
+            self.cache.reset()
+
+
+class SessionStore:
+    """Conversations keyed by session id.
+
+    Sessions idle for longer than `ttl_seconds` are dropped, and above
+    `max_sessions` the least recently used one is evicted. The KV caches of all
+    sessions together hold at most about `max_cached_tokens` tokens: above it,
+    the caches of the least recently used idle sessions are freed while their
+    histories are kept.
+    """
+
+    def __init__(
+        self,
+        create_session: Callable[[str], Session],
+        max_sessions: int = 32,
+        ttl_seconds: float = 1800.0,
+        max_cached_tokens: int = 32768,
+    ):
+        self.create_session = create_session
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_cached_tokens = max_cached_tokens
+
+        self.sessions: OrderedDict[str, Session] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id: str) -> Session:
+        with self.lock:
+            self.__evict_expired()
+
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.create_session(session_id)
+                self.sessions[session_id] = session
+
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+
+            self.sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+            self.__release_caches(session)
+
+            return session
+
+    def reset(self, session_id: str) -> None:
+        with self.lock:
+            session = self.sessions.get(session_id)
+
+        if session is not None:
+            with session.lock:
+                session.reset()
+
+    def __release_caches(self, current: Session) -> None:
+        cached = [
+            session for session in self.sessions.values() if session.cache is not None
+        ]
+        total = sum(session.cache.num_tokens for session in cached)
+
+        # least recently used first, the session about to be used is kept
+        for session in cached:
+            if total <= self.max_cached_tokens:
+                break
+            if session is current or session.cache.num_tokens == 0:
+                continue
+
+            # a session generating a turn is using its cache
+            if not session.lock.acquire(blocking=False):
+                continue
+            try:
+                total -= session.cache.num_tokens
+                session.cache.release()
+            finally:
+                session.lock.release()
+
+    def __evict_expired(self) -> None:
+        deadline = time.monotonic() - self.ttl_seconds
+
+        # sessions are kept in the order of their last use
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if session.last_used >= deadline:
+                break
+
+            self.sessions.popitem(last=False)
+
+
+class ContextCompactor:
+    """Keeps the prompt of a session within a token budget.
+
+    Once the history exceeds `token_budget`, old messages longer than
+    `max_message_tokens` (typically tool outputs) are truncated first, then the
+    oldest turns are dropped until the history fits into `target_ratio` of the
+    budget. The system prompt and the latest message are always kept.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        token_budget: int = 6144,
+        max_message_tokens: int = 1024,
+        target_ratio: float = 0.75,
+    ):
+        self.tokenizer = tokenizer
+        self.token_budget = token_budget
+        self.max_message_tokens = max_message_tokens
+        self.target = int(token_budget * target_ratio)
+
+    def count(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def compact(self, session: Session) -> bool:
+        """Returns whether the history of the session was changed"""
+        if sum(session.token_counts) <= self.token_budget:
+            return False
+
+        history, token_counts = session.history, session.token_counts
+
+        for position in range(1, len(history) - 1):
+            if token_counts[position] > self.max_message_tokens:
+                input_ids = self.tokenizer(
+                    history[position]["content"], add_special_tokens=False
+                ).input_ids
+                content = (
+                    self.tokenizer.decode(input_ids[: self.max_message_tokens])
+                    + TRUNCATION_NOTE
+                )
+
+                history[position] = {**history[position], "content": content}
+                token_counts[position] = self.count(content)
+
+            if sum(token_counts) <= self.target:
+                return True
+
+        while sum(token_counts) > self.target and len(history) > 2:
+            del history[1]
+            del token_counts[1]
+
+        return True
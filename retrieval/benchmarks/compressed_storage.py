@@ -0,0 +1,98 @@
+"""Memory and recall of the compressed vector storage against the flat index.
+
+Memory is the size of the serialized index, which is what stays resident; the
+float store used for re-ranking lives on disk. Every codec is also checked to
+leave out excluded (deleted) ids of its k-NN and range searches, the script
+exits with an error when one does not.
+
+Run from the retrieval directory:
+    python -m benchmarks.compressed_storage --num-vectors 500000
+"""
+
+from benchmarks.index_backends import make_vectors, recall_at_k, timed_search
+from src.index_backends import CompressedBackend, FlatBackend
+
+import faiss
+
+import numpy as np
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+
+def megabytes_per_million(backend) -> float:
+    size = faiss.serialize_index(backend.index).nbytes
+
+    return size / backend.ntotal * 1_000_000 / 2**20
+
+
+def excludes(backend, queries: np.ndarray, k: int, expected: np.ndarray) -> bool:
+    """Whether searches leave out the excluded ids and still find k neighbours"""
+    exclude = np.unique(expected[:, : k // 2])
+    _, found = backend.search(queries, k, exclude=exclude)
+    if np.isin(found, exclude).any() or (found < 0).any():
+        return False
+
+    _, found = backend.range_search(queries[:1], radius=2.0, exclude=exclude)
+
+    return not np.isin(found, exclude).any()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-vectors", type=int, default=200_000)
+    parser.add_argument("--num-queries", type=int, default=1000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--pq-m", type=int, default=48)
+    parser.add_argument("--rerank-factor", type=int, default=4)
+    args = parser.parse_args()
+
+    vectors = make_vectors(args.num_vectors, args.dimension, num_clusters=1024)
+    queries = make_vectors(args.num_queries, args.dimension, num_clusters=1024, seed=1)
+
+    flat = FlatBackend(args.dimension)
+    flat.add(vectors)
+    expected, latency = timed_search(flat, queries, args.k)
+    print(
+        f"flat: {megabytes_per_million(flat):.0f} MB per million chunks,"
+        f" recall@{args.k}=1.000 latency={latency:.3f} ms/query"
+    )
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        for codec in ("fp16", "int8", "pq"):
+            for rerank in (False, True):
+                start = time.perf_counter()
+                backend = CompressedBackend(
+                    args.dimension,
+                    codec=codec,
+                    pq_m=args.pq_m,
+                    rerank_factor=args.rerank_factor,
+                    float_store=(
+                        os.path.join(directory, f"{codec}.f32") if rerank else None
+                    ),
+                )
+                backend.add(vectors)
+                build_time = time.perf_counter() - start
+
+                found, latency = timed_search(backend, queries, args.k)
+                report = (
+                    f"{codec}{' + rerank' if rerank else ''}:"
+                    f" {megabytes_per_million(backend):.0f} MB per million chunks,"
+                    f" recall@{args.k}={recall_at_k(found, expected):.3f}"
+                    f" latency={latency:.3f} ms/query, built in {build_time:.1f} s"
+                )
+                if not excludes(backend, queries[:100], args.k, expected[:100]):
+                    report += ", exclusion FAILED"
+                    failed = True
+                print(report)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""Stress test of searches running while documents are added and deleted.
+
+Ingestion threads add generated PDFs, one of them also deletes or replaces
+every few documents, which drives merges of the recent vectors, snapshots
+and compactions. Search threads meanwhile run every kind of search and check
+that each answer is consistent: no errors, only known documents, and a
+document's unique marker word and marker phrase match exactly that document
+while it is in the database and never another one. The script exits with an
+error when a check fails.
+
+Run from the retrieval directory:
+    python -m benchmarks.concurrency_stress --documents 300 --search-threads 8
+"""
+
+from src.retrieval_engine import SEARCH_MODES, RetrievalEngine
+
+import numpy as np
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+
+WORDS = (
+    "the contract party shall pay invoice within days of delivery notice "
+    "agreement term renewal liability damages clause section report revenue "
+    "quarter growth risk model data analysis result method table figure"
+).split()
+
+
+def marker(number: int) -> str:
+    return f"marker{number:06d}x"
+
+
+def marker_phrase(number: int) -> str:
+    return f"opening {marker(number)} closing"
+
+
+def write_pdf(path: str, lines: list[str]) -> None:
+    """Writes a one-page PDF with the lines in a standard font"""
+    text = " ".join(f"({line}) '" for line in lines)
+    content = f"BT /F1 10 Tf 40 760 Td 12 TL {text} ET"
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R"
+        " /Resources << /Font << /F1 5 0 R >> >> >>",
+        f"<< /Length {len(content)} >>\nstream\n{content}\nendstream",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for offset in offsets:
+        pdf += f"{offset:010d} 00000 n \n".encode("latin-1")
+    pdf += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref}\n%%EOF\n"
+    ).encode("latin-1")
+
+    with open(path, "wb") as f:
+        f.write(pdf)
+
+
+def make_documents(directory: str, num_documents: int, seed: int = 0) -> list[str]:
+    generator = random.Random(seed)
+    paths = []
+    for number in range(num_documents):
+        lines = [
+            " ".join(generator.choices(WORDS, k=12))
+            for _ in range(generator.randint(5, 50))
+        ]
+        lines.insert(generator.randrange(len(lines)), marker_phrase(number))
+
+        path = os.path.join(directory, f"document_{number:06d}.pdf")
+        write_pdf(path, lines)
+        paths.append(path)
+
+    return paths
+
+
+class Stress:
+    def __init__(
+        self,
+        engine: RetrievalEngine,
+        paths: list[str],
+        replacements: list[str],
+        delete_every: int,
+    ):
+        self.engine = engine
+        self.paths = paths
+        # new versions of the documents, under the same names
+        self.replacements = replacements
+        self.names = {os.path.basename(path) for path in paths}
+        self.delete_every = delete_every
+
+        self.next_document = 0
+        self.added = []
+        self.live = set()
+        # documents a deletion of which may be under way
+        self.deleting = set()
+        self.deletions = 0
+        self.replaced = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+        self.errors = []
+        self.latencies = []
+
+    def fail(self, message: str) -> None:
+        with self.lock:
+            self.errors.append(message)
+
+    def ingest(self, deletes: bool) -> None:
+        while True:
+            with self.lock:
+                if self.next_document >= len(self.paths):
+                    return
+                number = self.next_document
+                self.next_document += 1
+
+            try:
+                self.engine.add_document(self.paths[number])
+                with self.lock:
+                    self.added.append(number)
+                    self.live.add(number)
+
+                if deletes and number % self.delete_every == 0:
+                    with self.lock:
+                        victim = random.choice(self.added)
+
+                    if number % (2 * self.delete_every) == 0:
+                        name = os.path.basename(self.paths[victim])
+                        with self.lock:
+                            self.deleting.add(victim)
+                        if self.engine.delete_document(name):
+                            with self.lock:
+                                self.live.discard(victim)
+                                self.deletions += 1
+                        with self.lock:
+                            self.deleting.discard(victim)
+                    else:
+                        self.engine.add_document(self.replacements[victim])
+                        with self.lock:
+                            self.live.add(victim)
+                            self.replaced += 1
+            except Exception:
+                self.fail(traceback.format_exc())
+
+    def check_names(self, names: list[str], what: str) -> None:
+        unknown = set(names) - self.names
+        if unknown:
+            self.fail(f"{what} returned unknown documents {sorted(unknown)}")
+
+    def is_visible(self, number: int) -> bool:
+        """Whether the document is surely searchable right now"""
+        with self.lock:
+            return number in self.live and number not in self.deleting
+
+    def search(self, seed: int) -> None:
+        generator = random.Random(seed)
+        while not self.done.is_set():
+            number = generator.randrange(len(self.paths))
+            name = os.path.basename(self.paths[number])
+            start = time.perf_counter()
+            try:
+                for query in (marker(number), marker_phrase(number)):
+                    visible = self.is_visible(number)
+                    found = self.engine.get_list_of_similar_documents(
+                        query, mode="lexical"
+                    )
+                    # a document added before and not deleted during the
+                    # search has to be found
+                    expected = [name] if visible and self.is_visible(number) else []
+                    if found not in (expected, [name]):
+                        self.fail(f"{query!r} of {name} matched {found}")
+
+                mode = generator.choice(SEARCH_MODES)
+                query = " ".join(generator.choices(WORDS, k=4))
+                self.check_names(
+                    self.engine.get_list_of_similar_documents(query, mode=mode), mode
+                )
+
+                context = self.engine.search(query, top_k=5)
+                self.check_names(
+                    [
+                        line[len("From document: ") : -1]
+                        for line in context.splitlines()
+                        if line.startswith("From document: ")
+                    ],
+                    "search",
+                )
+
+                self.engine.get_document(name)
+            except Exception:
+                self.fail(traceback.format_exc())
+
+            with self.lock:
+                self.latencies.append(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--ingest-threads", type=int, default=2)
+    parser.add_argument("--search-threads", type=int, default=8)
+    parser.add_argument("--delete-every", type=int, default=4)
+    parser.add_argument("--index-backend", default="flat")
+    parser.add_argument("--snapshot-every", type=int, default=10)
+    parser.add_argument("--snapshot-growth", type=float, default=0.25)
+    parser.add_argument("--recent-capacity", type=int, default=64)
+    parser.add_argument("--compaction-threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_documents(directory, args.documents)
+        replacement_directory = os.path.join(directory, "replacements")
+        os.makedirs(replacement_directory)
+        replacements = make_documents(replacement_directory, args.documents, seed=1)
+        engine = RetrievalEngine(
+            data_directory=os.path.join(directory, "index_data"),
+            snapshot_every=args.snapshot_every,
+            snapshot_growth=args.snapshot_growth,
+            index_backend=args.index_backend,
+            compaction_threshold=args.compaction_threshold,
+            recent_capacity=args.recent_capacity,
+        )
+        stress = Stress(engine, paths, replacements, args.delete_every)
+
+        ingesters = [
+            threading.Thread(target=stress.ingest, args=(number == 0,))
+            for number in range(args.ingest_threads)
+        ]
+        searchers = [
+            threading.Thread(target=stress.search, args=(number,))
+            for number in range(args.search_threads)
+        ]
+
+        start = time.perf_counter()
+        for thread in searchers + ingesters:
+            thread.start()
+        for thread in ingesters:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        stress.done.set()
+        for thread in searchers:
+            thread.join()
+
+        # a compaction may still be running in the background
+        with engine.write_lock:
+            stats = engine.stats()
+
+        if stats["documents"] != len(stress.live):
+            stress.fail(
+                f"{stats['documents']} documents left, expected {len(stress.live)}"
+            )
+
+        latencies = np.array(stress.latencies) * 1000
+        print(
+            f"{len(stress.added)} documents added, {stress.deletions} deleted"
+            f" and {stress.replaced} replaced"
+            f" in {elapsed:.1f} s, {len(latencies)} search rounds,"
+            f" p50 {np.percentile(latencies, 50):.1f} ms"
+            f" p99 {np.percentile(latencies, 99):.1f} ms"
+        )
+        print(stats)
+
+    for error in stress.errors[:10]:
+        print(error, file=sys.stderr)
+    if stress.errors:
+        print(f"FAILED with {len(stress.errors)} errors", file=sys.stderr)
+
+    sys.exit(1 if stress.errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Parity and throughput of the embedding backends against eager PyTorch.
+
+Every backend embeds the same chunks, the cosine similarity of its embeddings
+to the PyTorch ones is checked against --min-cosine and the script exits with
+an error when a backend falls below it.
+
+Run from the retrieval directory:
+    python -m benchmarks.embedding_backends --threads 4 --num-texts 2000
+"""
+
+from src.embedding_backends import EMBEDDING_BACKENDS, make_embedding_backend
+from transformers import AutoTokenizer
+
+import numpy as np
+
+import argparse
+import sys
+import time
+
+
+def make_texts(num_texts: int, seed: int = 0) -> list[str]:
+    """Sentences of varying length over a small vocabulary, like document chunks"""
+    generator = np.random.default_rng(seed)
+    words = (
+        "the contract party shall pay invoice within days of delivery notice "
+        "agreement term renewal liability damages clause section report revenue "
+        "quarter growth risk model data analysis result method table figure"
+    ).split()
+
+    return [
+        " ".join(generator.choice(words, size=generator.integers(8, 300)))
+        for _ in range(num_texts)
+    ]
+
+
+def embed_all(backend, tokenizer, texts: list[str], batch_size: int):
+    """Embeds the texts in length-sorted batches like the ingestion does"""
+    input_ids = tokenizer(texts, truncation=True)["input_ids"]
+    order = sorted(range(len(texts)), key=lambda idx: len(input_ids[idx]))
+
+    embeddings = np.empty((len(texts), backend.dimension), dtype=np.float32)
+    start = time.perf_counter()
+    for batch_start in range(0, len(order), batch_size):
+        positions = order[batch_start : batch_start + batch_size]
+        encoded_input = tokenizer.pad(
+            {"input_ids": [input_ids[idx] for idx in positions]},
+            padding=True,
+            return_tensors="np",
+        )
+        embeddings[positions] = backend.encode(
+            encoded_input["input_ids"], encoded_input["attention_mask"]
+        )
+    elapsed = time.perf_counter() - start
+
+    return embeddings, len(texts) / elapsed
+
+
+def query_latency(backend, tokenizer, queries: list[str]) -> float:
+    """Milliseconds per single-sentence embedding, as for a search request"""
+    start = time.perf_counter()
+    for query in queries:
+        encoded_input = tokenizer(query, return_tensors="np")
+        backend.encode(encoded_input["input_ids"], encoded_input["attention_mask"])
+
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--model-id", default="sentence-transformers/all-MiniLM-L6-v2"
+    )
+    parser.add_argument("--num-texts", type=int, default=1000)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--interop-threads", type=int, default=None)
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    parser.add_argument(
+        "--backends", nargs="+", default=list(EMBEDDING_BACKENDS)
+    )
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_id)
+    texts = make_texts(args.num_texts)
+    queries = [text[:100] for text in make_texts(args.num_queries, seed=1)]
+
+    reference = None
+    failed = False
+    for name in ["torch"] + [name for name in args.backends if name != "torch"]:
+        backend = make_embedding_backend(
+            name,
+            args.model_id,
+            num_threads=args.threads,
+            num_interop_threads=args.interop_threads,
+        )
+
+        embeddings, throughput = embed_all(
+            backend, tokenizer, texts, args.batch_size
+        )
+        latency = query_latency(backend, tokenizer, queries)
+        report = (
+            f"{name}: {throughput:.1f} chunks/s, query latency {latency:.2f} ms"
+        )
+
+        if reference is None:
+            reference, reference_throughput = embeddings, throughput
+        else:
+            # both sides are normalized, the dot product is the cosine
+            cosine = np.sum(embeddings * reference, axis=1)
+            report += (
+                f", speedup {throughput / reference_throughput:.2f}x,"
+                f" cosine to torch min {cosine.min():.4f} mean {cosine.mean():.4f}"
+            )
+            if cosine.min() < args.min_cosine:
+                report += " FAILED"
+                failed = True
+
+        print(report)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
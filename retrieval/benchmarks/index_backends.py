@@ -0,0 +1,92 @@
+"""Recall and latency of the approximate index backends against the exact one.
+
+Run from the retrieval directory:
+    python -m benchmarks.index_backends --num-vectors 1000000 --nlist 4096
+"""
+
+from src.index_backends import FlatBackend, HNSWBackend, IVFFlatBackend
+
+import numpy as np
+
+import argparse
+import time
+
+
+def make_vectors(
+    num_vectors: int, dimension: int, num_clusters: int, seed: int = 0
+) -> np.ndarray:
+    """Normalized vectors drawn around random centers, like sentence embeddings"""
+    generator = np.random.default_rng(seed)
+    centers = generator.standard_normal((num_clusters, dimension))
+    assignments = generator.integers(0, num_clusters, num_vectors)
+
+    vectors = centers[assignments] + 0.5 * generator.standard_normal(
+        (num_vectors, dimension)
+    )
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    return vectors.astype(np.float32)
+
+
+def recall_at_k(found: np.ndarray, expected: np.ndarray) -> float:
+    hits = sum(
+        len(np.intersect1d(found_row, expected_row))
+        for found_row, expected_row in zip(found, expected)
+    )
+
+    return hits / expected.size
+
+
+def timed_search(backend, queries: np.ndarray, k: int, **knobs):
+    start = time.perf_counter()
+    _, indices = backend.search(queries, k, **knobs)
+    elapsed = time.perf_counter() - start
+
+    return indices, elapsed / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-vectors", type=int, default=200_000)
+    parser.add_argument("--num-queries", type=int, default=1000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    args = parser.parse_args()
+
+    vectors = make_vectors(args.num_vectors, args.dimension, num_clusters=args.nlist)
+    queries = make_vectors(
+        args.num_queries, args.dimension, num_clusters=args.nlist, seed=1
+    )
+
+    flat = FlatBackend(args.dimension)
+    flat.add(vectors)
+    expected, flat_latency = timed_search(flat, queries, args.k)
+    print(f"flat: recall@{args.k}=1.000 latency={flat_latency:.3f} ms/query")
+
+    start = time.perf_counter()
+    ivf = IVFFlatBackend(args.dimension, nlist=args.nlist)
+    ivf.add(vectors)
+    print(f"ivf_flat: built in {time.perf_counter() - start:.1f} s")
+    for nprobe in (1, 4, 16, 64, 256):
+        found, latency = timed_search(ivf, queries, args.k, nprobe=nprobe)
+        print(
+            f"ivf_flat nprobe={nprobe}: recall@{args.k}="
+            f"{recall_at_k(found, expected):.3f} latency={latency:.3f} ms/query"
+        )
+
+    start = time.perf_counter()
+    hnsw = HNSWBackend(args.dimension, m=args.hnsw_m)
+    hnsw.add(vectors)
+    print(f"hnsw: built in {time.perf_counter() - start:.1f} s")
+    for ef_search in (16, 32, 64, 128, 256):
+        found, latency = timed_search(hnsw, queries, args.k, ef_search=ef_search)
+        print(
+            f"hnsw efSearch={ef_search}: recall@{args.k}="
+            f"{recall_at_k(found, expected):.3f} latency={latency:.3f} ms/query"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Throughput of concurrent query embeddings with and without coalescing.
+
+Every thread embeds its own queries one at a time, like concurrent /search
+requests do, first each with its own forward pass and then through the
+EmbeddingBatcher for every --wait-ms.
+
+Run from the retrieval directory:
+    python -m benchmarks.query_batching --threads 32 --wait-ms 0 2 5
+"""
+
+from benchmarks.embedding_backends import make_texts
+from src.embedding_backends import make_embedding_backend
+from src.embedding_batcher import EmbeddingBatcher
+from transformers import AutoTokenizer
+
+import argparse
+import threading
+import time
+
+
+def run_concurrently(embed, queries: list[str], num_threads: int) -> float:
+    """Queries per second with the queries split between the threads"""
+    threads = [
+        threading.Thread(
+            target=lambda part: [embed(query) for query in part],
+            args=(queries[offset::num_threads],),
+        )
+        for offset in range(num_threads)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return len(queries) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--model-id", default="sentence-transformers/all-MiniLM-L6-v2"
+    )
+    parser.add_argument("--backend", default="torch")
+    parser.add_argument("--num-queries", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--wait-ms", type=float, nargs="+", default=[0.0, 2.0, 5.0])
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_id)
+    backend = make_embedding_backend(args.backend, args.model_id)
+    queries = [text[:100] for text in make_texts(args.num_queries, seed=1)]
+
+    def embed_batch(texts: list[str]):
+        encoded_input = tokenizer(
+            texts, padding=True, truncation=True, return_tensors="np"
+        )
+
+        return backend.encode(encoded_input["input_ids"], encoded_input["attention_mask"])
+
+    throughput = run_concurrently(
+        lambda query: embed_batch([query])[0], queries, args.threads
+    )
+    print(f"one forward pass per query: {throughput:.1f} queries/s")
+
+    for wait_ms in args.wait_ms:
+        batcher = EmbeddingBatcher(embed_batch, args.batch_size, wait_ms)
+        batched_throughput = run_concurrently(batcher.embed, queries, args.threads)
+        stats = batcher.stats()
+        print(
+            f"coalesced within {wait_ms:g} ms: {batched_throughput:.1f} queries/s"
+            f" ({batched_throughput / throughput:.2f}x),"
+            f" mean batch {stats['mean_batch_size']:.1f},"
+            f" mean wait {stats['mean_wait_ms']:.2f} ms,"
+            f" max wait {stats['max_wait_ms']:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,65 @@
-from src.retrieval_engine import RetrievalEngine
+from src.retrieval_engine import SEARCH_MODES, RetrievalEngine
+from src.jobs import JobQueue, QueueFullError
 from pydantic import BaseModel
 from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response
+from pathlib import Path
+from typing import Callable, Literal
+import requests
+import json
+import logging
 import os
+import shutil
+import threading
+import uuid
 
+# uploads are written to disk in pieces of this size
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
-engine = RetrievalEngine()
+# "writer" owns the ingestion, "reader" processes serve the searches from the
+# snapshots of the writer on the same data directory and forward changes to it
+ROLE = os.environ.get("RETRIEVAL_ROLE", "writer")
+WRITER_URL = os.environ.get("RETRIEVAL_WRITER_URL", "http://retrieval_writer:8002")
+# how often a reader looks for new snapshots and logged changes
+REFRESH_SECONDS = float(os.environ.get("RETRIEVAL_REFRESH_SECONDS", 1.0))
+FORWARD_TIMEOUT = int(os.environ.get("RETRIEVAL_FORWARD_TIMEOUT", 60))
+
+engine = RetrievalEngine(
+    data_directory=os.environ.get("RETRIEVAL_DATA_DIR", "./index_data"),
+    extraction_workers=int(os.environ.get("PDF_EXTRACTION_WORKERS", 1)),
+    embedding_cache_size=int(os.environ.get("EMBEDDING_CACHE_SIZE", 100_000)),
+    embedding_cache_directory=os.environ.get("EMBEDDING_CACHE_DIR"),
+    index_backend=os.environ.get("INDEX_BACKEND", "flat"),
+    index_options=json.loads(os.environ.get("INDEX_OPTIONS", "{}")),
+    embedding_backend=os.environ.get("EMBEDDING_BACKEND", "torch"),
+    embedding_options=json.loads(os.environ.get("EMBEDDING_OPTIONS", "{}")),
+    read_only=ROLE == "reader",
+    query_batch_size=int(os.environ.get("QUERY_BATCH_SIZE", 32)),
+    query_batch_wait_ms=float(os.environ.get("QUERY_BATCH_WAIT_MS", 2.0)),
+    result_cache_size=int(os.environ.get("RESULT_CACHE_SIZE", 10_000)),
+)
+UPLOAD_DIRECTORY = "./saved_files"
+
+
+def ingest_upload(
+    path: str, name: str, progress: Callable[[str, float], None]
+) -> str | None:
+    try:
+        return engine.add_document(path, progress, name=name)
+    finally:
+        # the pages are kept by the engine once the upload is ingested
+        shutil.rmtree(Path(path).parent, ignore_errors=True)
+
+
+jobs = None
+if not engine.read_only:
+    jobs = JobQueue(
+        ingest_upload,
+        max_workers=int(os.environ.get("INGESTION_WORKERS", 2)),
+        max_pending=int(os.environ.get("INGESTION_MAX_PENDING", 32)),
+    )
+stop_refreshing = threading.Event()
 
 app = FastAPI(
     title="Vector Storage",
@@ -25,30 +79,122 @@ class DocumentResponse(BaseModel):
 class RetrievalSearchParameters(BaseModel):
     prompt: str
     top_k: int
+    # search-time knobs of the IVF and HNSW index backends
+    nprobe: int | None = None
+    ef_search: int | None = None
 
 
 class RetrievalResponse(BaseModel):
     response: str
 
 
+class BatchSearchParameters(BaseModel):
+    prompts: list[str]
+    top_k: int
+    nprobe: int | None = None
+    ef_search: int | None = None
+
+
+class SearchResultResponse(BaseModel):
+    chunk_id: int
+    document: str
+    score: float
+    text: str
+
+
+class BatchSearchResponse(BaseModel):
+    # results of every prompt in the order of the prompts
+    results: list[list[SearchResultResponse]]
+
+
 class SearchParameters(BaseModel):
     fragment: str
+    # "lexical", "dense" or "hybrid"
+    mode: Literal[SEARCH_MODES] = "lexical"
 
 
 class SearchResponse(BaseModel):
     search_results: list[str]
 
 
+class JobProgressResponse(BaseModel):
+    status: str
+    stage: str
+    progress: float
+
+
+class JobResponse(JobProgressResponse):
+    id: str
+    filename: str
+    error: str | None
+    duplicate_of: str | None
+    created_at: float
+    finished_at: float | None
+
+
+def follow_writer() -> None:
+    """Keeps a reader up to date with the writer until the process stops"""
+    while not stop_refreshing.wait(REFRESH_SECONDS):
+        try:
+            engine.refresh()
+        except Exception:
+            # a snapshot may have been replaced while it was being loaded
+            logging.getLogger(__name__).exception("Refreshing the index failed")
+
+
+def forward(method: str, path: str, **kwargs) -> Response:
+    """Passes a request of a reader on to the writer"""
+    response = requests.request(
+        method, f"{WRITER_URL}{path}", timeout=FORWARD_TIMEOUT, **kwargs
+    )
+
+    return Response(
+        content=response.content,
+        status_code=response.status_code,
+        media_type=response.headers.get("content-type"),
+    )
+
+
+@app.on_event("startup")
+def startup():
+    if engine.read_only:
+        threading.Thread(target=follow_writer, daemon=True).start()
+
+
 @app.post("/search")
 def search(request: RetrievalSearchParameters):
-    response = engine.search(request.prompt, request.top_k)
+    response = engine.search(
+        request.prompt,
+        request.top_k,
+        nprobe=request.nprobe,
+        ef_search=request.ef_search,
+    )
 
     return response
 
 
+@app.post("/search_batch", response_model=BatchSearchResponse)
+def search_batch(request: BatchSearchParameters):
+    results = engine.search_many(
+        request.prompts,
+        request.top_k,
+        nprobe=request.nprobe,
+        ef_search=request.ef_search,
+    )
+
+    return BatchSearchResponse(
+        results=[
+            [SearchResultResponse(**result.__dict__) for result in row]
+            for row in results
+        ]
+    )
+
+
 @app.post("/search_similar")
 def search_similar_documents(request: SearchParameters):
-    response = engine.get_list_of_similar_documents(request.fragment)
+    response = engine.get_list_of_similar_documents(
+        request.fragment, mode=request.mode
+    )
 
     return response
 
@@ -60,28 +206,103 @@ def get_document(request: DocumentParameters):
     return response
 
 
+@app.post("/delete_document")
+def delete_document(request: DocumentParameters):
+    if engine.read_only:
+        return forward("POST", "/delete_document", json=request.model_dump())
+
+    if not engine.delete_document(request.name):
+        return JSONResponse(
+            status_code=404,
+            content={"message": f"There is no document with the name {request.name}"},
+        )
+
+    return {"message": f"Document {request.name} was deleted"}
+
+
 @app.post("/add_document")
 async def add_document(file: UploadFile = File(...)):
+    if engine.read_only:
+        return await run_in_threadpool(
+            forward,
+            "POST",
+            "/add_document",
+            files={"file": (file.filename, file.file, file.content_type)},
+        )
+
     try:
-        # Save the file or just read the contents
-        save_directory = "./saved_files"
-        os.makedirs(save_directory, exist_ok=True)
+        # every upload gets its own directory, so that concurrent uploads of
+        # files with the same name do not overwrite each other
+        save_directory = os.path.join(UPLOAD_DIRECTORY, uuid.uuid4().hex)
+        os.makedirs(save_directory)
 
-        file_path = os.path.join(save_directory, file.filename)
+        filename = Path(file.filename).name
+        file_path = os.path.join(save_directory, filename)
         with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+            while content := await file.read(UPLOAD_CHUNK_SIZE):
+                f.write(content)
 
-        engine.add_document(file_path)
+        job = jobs.submit(file_path, filename)
 
         return JSONResponse(
-            status_code=200, content={"message": "File uploaded successfully"}
+            status_code=202,
+            content={"message": "File uploaded successfully", "job_id": job.id},
+        )
+    except QueueFullError as e:
+        shutil.rmtree(save_directory, ignore_errors=True)
+        return JSONResponse(
+            status_code=429, content={"message": "Too many uploads", "details": str(e)}
         )
     except Exception as e:
         return JSONResponse(
             status_code=500, content={"message": "An error occurred", "details": str(e)}
         )
 
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+def get_job(job_id: str):
+    if engine.read_only:
+        return forward("GET", f"/jobs/{job_id}")
+
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(
+            status_code=404, content={"message": f"There is no job {job_id}"}
+        )
+
+    return JobResponse(**job.__dict__)
+
+
+@app.get("/jobs/{job_id}/progress", response_model=JobProgressResponse)
+def get_job_progress(job_id: str):
+    if engine.read_only:
+        return forward("GET", f"/jobs/{job_id}/progress")
+
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(
+            status_code=404, content={"message": f"There is no job {job_id}"}
+        )
+
+    return JobProgressResponse(status=job.status, stage=job.stage, progress=job.progress)
+
+
+@app.get("/stats")
+def stats():
+    return engine.stats()
+
+
 @app.post("/reset")
 def reset():
-    engine.reset()
\ No newline at end of file
+    if engine.read_only:
+        return forward("POST", "/reset")
+
+    engine.reset()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    stop_refreshing.set()
+    if jobs is not None:
+        jobs.shutdown()
+    engine.snapshot()
@@ -1,18 +1,64 @@
-from transformers import AutoTokenizer
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Iterator, Sequence
+from src.pdf_extraction import iter_pages
 import pypdfium2 as pdfium
 from pathlib import Path
+import numpy as np
+import hashlib
 
 
 class Document:
-    def __init__(self, path: str):
-        pdf = pdfium.PdfDocument(path)
-
-        self.pages = [
-            pdf.get_page(idx).get_textpage().get_text_bounded()
-            for idx in range(len(pdf))
-        ]
-        self.name: str = Path(path).name
+    def __init__(self, path: str, num_workers: int = 1, name: str | None = None):
+        self.path = path
+        self.name: str = name or Path(path).name
+        self.num_workers = num_workers
+
+        self._pages: Sequence[str] | None = None
+
+    @classmethod
+    def from_pages(
+        cls, name: str, pages: Sequence[str], content_hash: str | None = None
+    ) -> "Document":
+        """Restores a document from already extracted pages"""
+        document = cls.__new__(cls)
+        document.path = None
+        document.name = name
+        document.num_workers = 1
+        document._pages = pages
+        document.content_hash = content_hash
+
+        return document
+
+    @cached_property
+    def content_hash(self) -> str:
+        """Hash of the file contents, computed without parsing the PDF"""
+        digest = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            while block := f.read(1024 * 1024):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+    @property
+    def pages(self) -> Sequence[str]:
+        if self._pages is None:
+            self._pages = list(self.iter_pages())
+
+        return self._pages
+
+    def iter_pages(self) -> Iterator[str]:
+        """Yields the pages in order while they are being extracted"""
+        if self._pages is not None:
+            yield from self._pages
+            return
+
+        pages = []
+        for page in iter_pages(self.path, self.num_workers):
+            pages.append(page)
+            yield page
+
+        self._pages = pages
 
     def __len__(self):
         return len(self.pages)
@@ -35,40 +81,128 @@ class Chunk:
     id: int
     # chunk's document name
     document_name: str
-
-
-class ChunkStorage:
-    def __init__(self, tokenizer_id: str):
-        self.chunks = []
-        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_id)
+    # token ids of the chunk, including the special tokens
+    input_ids: list[int] = field(default_factory=list, repr=False)
+
+
+class ChunkTable:
+    """Append-only sequence of chunks.
+
+    The leading chunks may be served from a read-only (memory-mapped) snapshot,
+    chunks added after it are kept in memory. Next to the chunks the table keeps
+    the numeric id of every chunk's document for vectorized lookups.
+    """
+
+    def __init__(
+        self,
+        frozen: Sequence[Chunk] = (),
+        frozen_document_ids: np.ndarray | None = None,
+    ):
+        self.frozen = frozen
+        self.frozen_document_ids = (
+            frozen_document_ids
+            if frozen_document_ids is not None
+            else np.empty(0, dtype=np.int32)
+        )
+        self.tail: list[Chunk] = []
+
+        # grown by reallocation, so that readers keep a consistent array
+        self.tail_document_ids = np.empty(1024, dtype=np.int32)
 
     def __len__(self):
-        return len(self.chunks)
+        return len(self.frozen) + len(self.tail)
 
     def __getitem__(self, index: int) -> Chunk:
-        if len(self.chunks) == 0:
-            raise ValueError("There are no chunks in the storage. Try to add one.")
+        if index < len(self.frozen):
+            return self.frozen[index]
+
+        return self.tail[index - len(self.frozen)]
+
+    def __iter__(self) -> Iterator[Chunk]:
+        for index in range(len(self.frozen)):
+            yield self.frozen[index]
+
+        yield from self.tail
+
+    def extend(self, chunks: list[Chunk], document_id: int) -> None:
+        start, stop = len(self.tail), len(self.tail) + len(chunks)
+
+        if stop > len(self.tail_document_ids):
+            document_ids = np.empty(
+                max(stop, 2 * len(self.tail_document_ids)), dtype=np.int32
+            )
+            document_ids[:start] = self.tail_document_ids[:start]
+            self.tail_document_ids = document_ids
+
+        self.tail_document_ids[start:stop] = document_id
+        self.tail.extend(chunks)
+
+    def document_range(self, document_id: int) -> tuple[int, int]:
+        """Ids of the first and past the last chunk of a document.
+
+        Documents are appended one after another, so the document ids of the
+        chunks never decrease and the chunks of a document are contiguous.
+        """
+        tail_document_ids = self.tail_document_ids[: len(self.tail)]
+
+        start, stop = (
+            np.searchsorted(self.frozen_document_ids, document_id, side)
+            + np.searchsorted(tail_document_ids, document_id, side)
+            for side in ("left", "right")
+        )
+
+        return int(start), int(stop)
+
+    def document_ids(self, chunk_ids: np.ndarray) -> np.ndarray:
+        """Maps an array of chunk ids to the ids of their documents"""
+        num_frozen = len(self.frozen_document_ids)
+        tail_document_ids = self.tail_document_ids
+
+        in_frozen = chunk_ids < num_frozen
+        document_ids = np.empty(len(chunk_ids), dtype=np.int32)
+        document_ids[in_frozen] = self.frozen_document_ids[chunk_ids[in_frozen]]
+        document_ids[~in_frozen] = tail_document_ids[chunk_ids[~in_frozen] - num_frozen]
+
+        return document_ids
+
+
+class Chunker:
+    """Splits documents into chunks of at most `max_length` tokens"""
+
+    def __init__(self, tokenizer, max_length: int = 512):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+
+    def chunk_document(self, document: Document) -> list[Chunk]:
+        """Splits the document into chunks.
 
-        if index < 0 or index >= len(self.chunks):
-            raise IndexError(f"There is no chunk at {index} position.")
+        Pages are tokenized as they are extracted, so chunking does not wait for
+        the whole document to be parsed.
+        """
+        window = self.max_length - self.tokenizer.num_special_tokens_to_add()
 
-        return self.chunks[index]
+        new_chunks = []
+        buffer = []
+        for page in document.iter_pages():
+            buffer.extend(self.tokenizer(page, add_special_tokens=False)["input_ids"])
 
-    def chunk_document(self, document: Document) -> None:
-        document_text = " ".join(document.pages)
+            start = 0
+            while len(buffer) - start >= window:
+                new_chunks.append(
+                    self.__make_chunk(
+                        buffer[start : start + window], len(new_chunks), document
+                    )
+                )
+                start += window
+            buffer = buffer[start:]
 
-        chunk_input_ids = self.tokenizer(
-            document_text,
-            max_length=512,
-            truncation=True,
-            return_overflowing_tokens=True,
-        )["input_ids"]
+        if len(buffer) > 0:
+            new_chunks.append(self.__make_chunk(buffer, len(new_chunks), document))
 
-        for chunk_id, input_ids in enumerate(chunk_input_ids):
-            chunk_text = self.tokenizer.decode(input_ids[1:-1])
-            chunk = Chunk(chunk_text, chunk_id, document.name)
+        return new_chunks
 
-            self.chunks.append(chunk)
+    def __make_chunk(self, token_ids: list[int], chunk_id: int, document: Document):
+        input_ids = self.tokenizer.build_inputs_with_special_tokens(token_ids)
+        chunk_text = self.tokenizer.decode(token_ids)
 
-    def reset(self):
-        self.chunks = []
\ No newline at end of file
+        return Chunk(chunk_text, chunk_id, document.name, input_ids)
@@ -0,0 +1,218 @@
+from transformers import AutoModel
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+class _CLSPooler(torch.nn.Module):
+    """Sentence embeddings: normalized hidden state of the CLS token"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        model_output = self.model(input_ids=input_ids, attention_mask=attention_mask)
+
+        return torch.nn.functional.normalize(model_output[0][:, 0], p=2, dim=1)
+
+
+class EmbeddingBackend:
+    """Base class of the runtimes that embed tokenized text.
+
+    `num_threads` and `num_interop_threads` bound the threads used inside one
+    operator and across independent operators, None leaves the runtime default.
+    """
+
+    name = ""
+
+    def __init__(
+        self,
+        model_id: str,
+        num_threads: int | None = None,
+        num_interop_threads: int | None = None,
+    ):
+        self.model_id = model_id
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+
+    @property
+    def dimension(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def cache_id(self) -> str:
+        """Identifies the embeddings of this backend in the embedding cache"""
+        return f"{self.model_id}@{self.name}"
+
+    def encode(self, input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        """Embeds a padded batch, returns float32 vectors of unit length"""
+        raise NotImplementedError
+
+
+class TorchBackend(EmbeddingBackend):
+    """Eager PyTorch in float32"""
+
+    name = "torch"
+
+    def __init__(
+        self,
+        model_id: str,
+        num_threads: int | None = None,
+        num_interop_threads: int | None = None,
+    ):
+        super().__init__(model_id, num_threads, num_interop_threads)
+
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        if num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError:
+                # can only be set once, before any parallel work has started
+                pass
+
+        self.model = AutoModel.from_pretrained(model_id)
+        self.model.eval()
+        self.pooler = _CLSPooler(self.model)
+
+    @property
+    def dimension(self) -> int:
+        return self.model.config.hidden_size
+
+    def encode(self, input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            embeddings = self.pooler(
+                torch.as_tensor(input_ids), torch.as_tensor(attention_mask)
+            )
+
+        return embeddings.cpu().numpy().astype(np.float32, copy=False)
+
+
+class ONNXBackend(EmbeddingBackend):
+    """ONNX Runtime on CPU.
+
+    The model is exported once into `directory` together with the pooling,
+    later starts load the exported file.
+    """
+
+    name = "onnx"
+
+    def __init__(
+        self,
+        model_id: str,
+        num_threads: int | None = None,
+        num_interop_threads: int | None = None,
+        directory: str = "./onnx_models",
+    ):
+        super().__init__(model_id, num_threads, num_interop_threads)
+
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError(
+                f"The {self.name} embedding backend requires onnxruntime."
+            ) from e
+
+        self.directory = Path(directory) / model_id.replace("/", "--")
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        if num_interop_threads is not None:
+            options.inter_op_num_threads = num_interop_threads
+
+        self.session = onnxruntime.InferenceSession(
+            str(self.model_path()), options, providers=["CPUExecutionProvider"]
+        )
+        self.__dimension = self.session.get_outputs()[0].shape[1]
+
+    @property
+    def dimension(self) -> int:
+        return self.__dimension
+
+    def export(self, path: Path) -> None:
+        model = AutoModel.from_pretrained(self.model_id)
+        model.eval()
+
+        dummy_input = (
+            torch.ones((1, 8), dtype=torch.long),
+            torch.ones((1, 8), dtype=torch.long),
+        )
+        temporary_path = path.with_suffix(".tmp")
+        torch.onnx.export(
+            _CLSPooler(model),
+            dummy_input,
+            str(temporary_path),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["embeddings"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "embeddings": {0: "batch"},
+            },
+            opset_version=14,
+        )
+        temporary_path.replace(path)
+
+    def model_path(self) -> Path:
+        path = self.directory / "model.onnx"
+        if not path.exists():
+            self.export(path)
+
+        return path
+
+    def encode(self, input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        (embeddings,) = self.session.run(
+            None,
+            {
+                "input_ids": np.asarray(input_ids, dtype=np.int64),
+                "attention_mask": np.asarray(attention_mask, dtype=np.int64),
+            },
+        )
+
+        return embeddings.astype(np.float32, copy=False)
+
+
+class ONNXInt8Backend(ONNXBackend):
+    """ONNX Runtime with dynamically quantized int8 weights.
+
+    Weights of the matrix multiplications are stored as int8, activations are
+    quantized on the fly, which is what makes the linear layers faster on CPU.
+    """
+
+    name = "onnx_int8"
+
+    def model_path(self) -> Path:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        path = self.directory / "model_int8.onnx"
+        if not path.exists():
+            temporary_path = path.with_suffix(".tmp")
+            quantize_dynamic(
+                str(super().model_path()),
+                str(temporary_path),
+                weight_type=QuantType.QInt8,
+            )
+            temporary_path.replace(path)
+
+        return path
+
+
+EMBEDDING_BACKENDS = {
+    backend.name: backend for backend in (TorchBackend, ONNXBackend, ONNXInt8Backend)
+}
+
+
+def make_embedding_backend(name: str, model_id: str, **options) -> EmbeddingBackend:
+    if name not in EMBEDDING_BACKENDS:
+        raise ValueError(
+            f"Unknown embedding backend {name}, choose one of {list(EMBEDDING_BACKENDS)}."
+        )
+
+    return EMBEDDING_BACKENDS[name](model_id, **options)
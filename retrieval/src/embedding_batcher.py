@@ -0,0 +1,103 @@
+from concurrent.futures import Future
+from typing import Callable
+
+import numpy as np
+
+import queue
+import threading
+import time
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent embedding calls of single texts into batches.
+
+    Calls wait at most `max_wait_ms` after the first text of a batch arrived for
+    others to join it, a batch is run as soon as it has `max_batch_size` texts.
+    `embed(texts)` embeds a batch, every caller gets the row of its own text.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[list[str]], np.ndarray],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 2.0,
+    ):
+        self.embed_batch = embed
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        # (text, future, time of the call)
+        self.queue: queue.Queue[tuple[str, Future, float]] = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.queries = 0
+        self.largest_batch = 0
+        self.total_wait = 0.0
+        self.longest_wait = 0.0
+        self.total_run_time = 0.0
+
+        self.thread = threading.Thread(
+            target=self.__run, name="query-embedding", daemon=True
+        )
+        self.thread.start()
+
+    def embed(self, text: str) -> np.ndarray:
+        """Embedding of one text, computed together with concurrent calls"""
+        future = Future()
+        self.queue.put((text, future, time.perf_counter()))
+
+        return future.result()
+
+    def __collect(self) -> list[tuple[str, Future, float]]:
+        batch = [self.queue.get()]
+        deadline = batch[0][2] + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    # whatever is already waiting joins without further delay
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def __run(self) -> None:
+        while True:
+            batch = self.__collect()
+            start = time.perf_counter()
+
+            try:
+                embeddings = self.embed_batch([text for text, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for row, (_, future, _) in enumerate(batch):
+                future.set_result(embeddings[row])
+
+            waits = [start - called_at for _, _, called_at in batch]
+            with self.lock:
+                self.batches += 1
+                self.queries += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+                self.total_wait += sum(waits)
+                self.longest_wait = max(self.longest_wait, *waits)
+                self.total_run_time += time.perf_counter() - start
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "queries": self.queries,
+                "mean_batch_size": self.queries / max(self.batches, 1),
+                "max_batch_size": self.largest_batch,
+                "mean_wait_ms": self.total_wait / max(self.queries, 1) * 1000,
+                "max_wait_ms": self.longest_wait * 1000,
+                "mean_batch_ms": self.total_run_time / max(self.batches, 1) * 1000,
+            }
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+
+import hashlib
+import os
+import threading
+
+
+class EmbeddingCache:
+    """Content-addressed cache of chunk embeddings.
+
+    Entries are keyed by the model id and the hash of the chunk's token ids. The
+    in-memory tier evicts the least recently used entries above `capacity`, the
+    optional on-disk tier keeps every vector it has seen.
+    """
+
+    def __init__(
+        self, model_id: str, capacity: int = 100_000, directory: str | None = None
+    ):
+        self.model_id = model_id
+        self.capacity = capacity
+
+        self.directory = None
+        if directory is not None:
+            self.directory = Path(directory)
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, input_ids: Sequence[int]) -> str:
+        digest = hashlib.sha1(self.model_id.encode("utf-8"))
+        digest.update(np.asarray(input_ids, dtype=np.int32).tobytes())
+
+        return digest.hexdigest()
+
+    def __disk_path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.npy"
+
+    def get(self, key: str) -> np.ndarray | None:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        if self.directory is not None and self.__disk_path(key).exists():
+            vector = np.load(self.__disk_path(key))
+            with self.lock:
+                self.disk_hits += 1
+                self.__remember(key, vector)
+            return vector
+
+        with self.lock:
+            self.misses += 1
+
+        return None
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        with self.lock:
+            self.__remember(key, vector)
+
+        if self.directory is not None:
+            path = self.__disk_path(key)
+            path.parent.mkdir(exist_ok=True)
+
+            # write to a temporary file first, readers must never see a partial one
+            temporary_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            with open(temporary_path, "wb") as f:
+                np.save(f, vector)
+            os.replace(temporary_path, path)
+
+    def __remember(self, key: str, vector: np.ndarray) -> None:
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+
+        return {
+            "entries": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
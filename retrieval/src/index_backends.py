@@ -0,0 +1,625 @@
+from src.vector_store import FloatVectorStore
+
+import numpy as np
+import faiss
+
+import copy
+
+
+def _exclusion(ids: np.ndarray | None) -> tuple | None:
+    """Selector of every id but the given ones, with the selector it wraps.
+
+    FAISS does not own the wrapped selector, both have to stay referenced for
+    as long as the search runs.
+    """
+    if ids is None or len(ids) == 0:
+        return None
+
+    excluded = faiss.IDSelectorBatch(np.asarray(ids, dtype=np.int64))
+
+    return faiss.IDSelectorNot(excluded), excluded
+
+
+def _ivf_contents(index: faiss.IndexIVF) -> tuple[np.ndarray, np.ndarray]:
+    """Vectors and ids stored in the inverted lists of an IVFFlat index"""
+    invlists = index.invlists
+    vectors, ids = [], []
+    for list_no in range(index.nlist):
+        size = invlists.list_size(list_no)
+        if size == 0:
+            continue
+
+        list_ids = invlists.get_ids(list_no)
+        list_codes = invlists.get_codes(list_no)
+        ids.append(faiss.rev_swig_ptr(list_ids, size).copy())
+        vectors.append(
+            faiss.rev_swig_ptr(list_codes, size * invlists.code_size)
+            .view(np.float32)
+            .reshape(size, index.d)
+            .copy()
+        )
+        invlists.release_ids(list_no, list_ids)
+        invlists.release_codes(list_no, list_codes)
+
+    if not ids:
+        return np.empty((0, index.d), dtype=np.float32), np.empty(0, dtype=np.int64)
+
+    return np.concatenate(vectors), np.concatenate(ids)
+
+
+class IndexBackend:
+    """Base class of the vector indexes used by the retrieval engine.
+
+    The wrapped FAISS index is available as `index`, it is what gets persisted.
+    Vectors are stored under explicit ids (the chunk ids of the engine) which
+    survive the removal of other vectors.
+    """
+
+    name = ""
+    # whether parts of the index are memory-mapped from the file of a snapshot
+    read_only = False
+
+    def __init__(self, dimension: int):
+        self.d = dimension
+        self.index = self.build()
+
+    def build(self) -> faiss.Index:
+        raise NotImplementedError
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray | None = None) -> None:
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + len(vectors))
+
+        self.index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+
+    def remove(self, ids: np.ndarray) -> bool:
+        """Drops the vectors with the given ids, returns whether it was possible"""
+        self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+        return True
+
+    def contents(self) -> tuple[np.ndarray, np.ndarray]:
+        """All stored vectors with their ids"""
+        storage = faiss.downcast_index(self.index.index)
+
+        return (
+            storage.reconstruct_n(0, self.index.ntotal),
+            faiss.vector_to_array(self.index.id_map).astype(np.int64),
+        )
+
+    def rebuild(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        """Replaces the contents of the index, used to renumber the ids"""
+        self.index = self.build()
+        if len(vectors) > 0:
+            self.add(vectors, ids)
+
+    def copy(self) -> "IndexBackend":
+        """Copy that can be changed while this backend keeps serving searches"""
+        backend = copy.copy(self)
+        backend.index = faiss.clone_index(self.index)
+
+        return backend
+
+    def rebuilt(self, vectors: np.ndarray, ids: np.ndarray) -> "IndexBackend":
+        """Copy holding only the given vectors, this backend is left as it is"""
+        backend = copy.copy(self)
+        backend.rebuild(vectors, ids)
+
+        return backend
+
+    def search_parameters(
+        self,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        sel: faiss.IDSelector | None = None,
+    ) -> faiss.SearchParameters | None:
+        if sel is None:
+            return None
+
+        return faiss.SearchParameters(sel=sel)
+
+    def search(
+        self,
+        vectors: np.ndarray,
+        k: int,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        exclude: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """`exclude` are ids that must not be returned, e.g. removed ones"""
+        exclusion = _exclusion(exclude)
+        params = self.search_parameters(
+            nprobe=nprobe,
+            ef_search=ef_search,
+            sel=exclusion[0] if exclusion is not None else None,
+        )
+        if params is None:
+            return self.index.search(vectors, k)
+
+        return self.index.search(vectors, k, params=params)
+
+    def range_search(
+        self,
+        vector: np.ndarray,
+        radius: float,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        exclude: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the distances and ids of all vectors closer than `radius`"""
+        exclusion = _exclusion(exclude)
+        params = self.search_parameters(
+            nprobe=nprobe,
+            ef_search=ef_search,
+            sel=exclusion[0] if exclusion is not None else None,
+        )
+        if params is None:
+            lims, distances, indices = self.index.range_search(vector, radius)
+        else:
+            lims, distances, indices = self.index.range_search(
+                vector, radius, params=params
+            )
+
+        return distances[lims[0] : lims[1]], indices[lims[0] : lims[1]]
+
+    def reset(self) -> None:
+        self.index = self.build()
+
+    def files(self) -> dict:
+        """Names of the files next to the index that its snapshot refers to"""
+        return {}
+
+    def restore(
+        self, index: faiss.Index, read_only: bool = False, files: dict | None = None
+    ) -> None:
+        """Takes over an index read from disk, with the `files()` it was saved with"""
+        self.index = index
+
+
+class FlatBackend(IndexBackend):
+    """Exact brute-force search"""
+
+    name = "flat"
+
+    def build(self) -> faiss.Index:
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(self.d))
+
+
+class IVFFlatBackend(IndexBackend):
+    """Inverted file index over `nlist` k-means cells.
+
+    Vectors are kept in an exact flat index until `train_size` of them exist,
+    then the coarse quantizer is trained on them and they are moved to the IVF.
+    """
+
+    name = "ivf_flat"
+
+    def __init__(
+        self,
+        dimension: int,
+        nlist: int = 1024,
+        nprobe: int = 16,
+        train_size: int | None = None,
+    ):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        # FAISS warns below 39 training points per centroid
+        self.train_size = train_size if train_size is not None else 39 * nlist
+        self.read_only = False
+
+        super().__init__(dimension)
+
+    def build(self) -> faiss.Index:
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(self.d))
+
+    @property
+    def is_trained(self) -> bool:
+        return isinstance(self.index, faiss.IndexIVF)
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray | None = None) -> None:
+        if self.read_only:
+            self.__load_into_memory()
+
+        super().add(vectors, ids)
+
+        if not self.is_trained and self.index.ntotal >= self.train_size:
+            self.__train()
+
+    def remove(self, ids: np.ndarray) -> bool:
+        if self.read_only:
+            self.__load_into_memory()
+
+        return super().remove(ids)
+
+    def contents(self) -> tuple[np.ndarray, np.ndarray]:
+        if not self.is_trained:
+            return super().contents()
+
+        return _ivf_contents(self.index)
+
+    def __train(self) -> None:
+        vectors, ids = super().contents()
+
+        quantizer = faiss.IndexFlatL2(self.d)
+        index = faiss.IndexIVFFlat(quantizer, self.d, self.nlist)
+        index.train(vectors)
+        index.add_with_ids(vectors, ids)
+
+        self.index = index
+
+    def __refill(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        """Moves the contents into a new in-memory IVF with the same quantizer"""
+        # the quantizer is owned by the old index, which is about to be freed
+        quantizer = faiss.clone_index(self.index.quantizer)
+        index = faiss.IndexIVFFlat(quantizer, self.d, self.nlist)
+        index.is_trained = True
+        if len(vectors) > 0:
+            index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+
+        self.index = index
+        self.read_only = False
+
+    def __load_into_memory(self) -> None:
+        """Copies a memory-mapped, read-only IVF into a writable one"""
+        self.__refill(*_ivf_contents(self.index))
+
+    def rebuild(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        if not self.is_trained:
+            super().rebuild(vectors, ids)
+            return
+
+        # the trained cells are kept, only the inverted lists are refilled
+        self.__refill(vectors, ids)
+
+    def copy(self) -> "IndexBackend":
+        if not self.read_only:
+            return super().copy()
+
+        # memory-mapped inverted lists can not be cloned, they are read instead
+        backend = copy.copy(self)
+        backend.__load_into_memory()
+
+        return backend
+
+    def restore(
+        self, index: faiss.Index, read_only: bool = False, files: dict | None = None
+    ) -> None:
+        if isinstance(index, faiss.IndexIVF):
+            self.nlist = index.nlist
+            self.read_only = read_only
+            self.index = index
+        else:
+            self.read_only = False
+            super().restore(index, read_only, files)
+
+    def search_parameters(
+        self,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        sel: faiss.IDSelector | None = None,
+    ) -> faiss.SearchParameters | None:
+        if not self.is_trained:
+            return super().search_parameters(sel=sel)
+
+        return faiss.SearchParametersIVF(nprobe=nprobe or self.nprobe, sel=sel)
+
+
+class HNSWBackend(IndexBackend):
+    """Hierarchical navigable small world graph, needs no training.
+
+    The graph can not drop vectors, removed ones are filtered out of the
+    results until the index is rebuilt.
+    """
+
+    name = "hnsw"
+
+    def __init__(
+        self,
+        dimension: int,
+        m: int = 32,
+        ef_construction: int = 200,
+        ef_search: int = 64,
+    ):
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+
+        super().__init__(dimension)
+
+    def build(self) -> faiss.Index:
+        index = faiss.IndexHNSWFlat(self.d, self.m)
+        index.hnsw.efConstruction = self.ef_construction
+
+        return faiss.IndexIDMap2(index)
+
+    def remove(self, ids: np.ndarray) -> bool:
+        return False
+
+    def search_parameters(
+        self,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        sel: faiss.IDSelector | None = None,
+    ) -> faiss.SearchParameters | None:
+        return faiss.SearchParametersHNSW(efSearch=ef_search or self.ef_search, sel=sel)
+
+    def range_search(
+        self,
+        vector: np.ndarray,
+        radius: float,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        exclude: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """The graph has no native range search, the k of a k-NN search is
+        doubled until the farthest neighbour falls outside of the radius"""
+        k = min(64, self.ntotal)
+        while True:
+            distances, indices = self.search(
+                vector,
+                k,
+                ef_search=max(k, ef_search or self.ef_search),
+                exclude=exclude,
+            )
+            distances, indices = distances[0], indices[0]
+
+            if k >= self.ntotal or distances[-1] >= radius:
+                within = (distances < radius) & (indices >= 0)
+                return distances[within], indices[within]
+
+            k = min(2 * k, self.ntotal)
+
+
+class CompressedBackend(IndexBackend):
+    """Exhaustive search over compressed vectors with an exact re-rank.
+
+    `codec` is "fp16" or "int8" scalar quantization (2 or 1 byte per
+    dimension) or "pq" product quantization (`pq_m` codes of `pq_nbits` bits
+    per vector). Codecs that need training keep the vectors in a flat index
+    until `train_size` of them exist. When a `float_store` path is given, the
+    full vectors are also written to numbered files next to it and the
+    `rerank_factor * k` nearest candidates are re-ranked by their exact
+    distances read from disk. Renumbering the ids starts a new file, a
+    snapshot refers to the file that matches its ids.
+    """
+
+    name = "compressed"
+
+    def __init__(
+        self,
+        dimension: int,
+        codec: str = "int8",
+        pq_m: int = 48,
+        pq_nbits: int = 8,
+        train_size: int | None = None,
+        rerank_factor: int = 4,
+        float_store: str | None = None,
+    ):
+        if codec not in ("fp16", "int8", "pq"):
+            raise ValueError(f"Unknown codec {codec}, choose one of fp16, int8, pq.")
+
+        self.codec = codec
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        if train_size is None:
+            # FAISS warns below 39 training points per centroid
+            train_size = {"fp16": 0, "int8": 1000, "pq": 39 * 2**pq_nbits}[codec]
+        self.train_size = train_size
+        self.rerank_factor = rerank_factor
+        self.float_store = (
+            FloatVectorStore.latest(float_store, dimension)
+            if float_store is not None
+            else None
+        )
+
+        super().__init__(dimension)
+
+    def __codec_index(self) -> faiss.Index:
+        if self.codec == "fp16":
+            return faiss.IndexScalarQuantizer(self.d, faiss.ScalarQuantizer.QT_fp16)
+        elif self.codec == "int8":
+            return faiss.IndexScalarQuantizer(self.d, faiss.ScalarQuantizer.QT_8bit)
+
+        return faiss.IndexPQ(self.d, self.pq_m, self.pq_nbits)
+
+    def build(self) -> faiss.Index:
+        if self.train_size == 0:
+            return faiss.IndexIDMap2(self.__codec_index())
+
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(self.d))
+
+    @property
+    def is_trained(self) -> bool:
+        return not isinstance(faiss.downcast_index(self.index.index), faiss.IndexFlat)
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray | None = None) -> None:
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + len(vectors))
+
+        if self.float_store is not None:
+            self.float_store.put(vectors, ids)
+
+        super().add(vectors, ids)
+
+        if not self.is_trained and self.index.ntotal >= self.train_size:
+            self.__train()
+
+    def __train(self) -> None:
+        vectors, ids = super().contents()
+
+        codec_index = self.__codec_index()
+        codec_index.train(vectors)
+        index = faiss.IndexIDMap2(codec_index)
+        index.add_with_ids(vectors, ids)
+
+        self.index = index
+
+    def contents(self) -> tuple[np.ndarray, np.ndarray]:
+        if self.float_store is None:
+            # decoded from the compressed codes
+            return super().contents()
+
+        ids = faiss.vector_to_array(self.index.id_map).astype(np.int64)
+
+        return self.float_store.get(ids), ids
+
+    def rebuild(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        # the old file stays with the states and the snapshot that use it
+        if self.float_store is not None:
+            self.float_store = self.float_store.rewritten(vectors, ids)
+
+        if not self.is_trained:
+            super().rebuild(vectors, ids)
+            return
+
+        # the trained codec is kept, only the codes are replaced
+        codec_index = faiss.clone_index(faiss.downcast_index(self.index.index))
+        codec_index.reset()
+        index = faiss.IndexIDMap2(codec_index)
+        if len(vectors) > 0:
+            index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+
+        self.index = index
+
+    def reset(self) -> None:
+        super().reset()
+
+        if self.float_store is not None:
+            self.float_store = self.float_store.rewritten(
+                np.empty((0, self.d), dtype=np.float32), np.empty(0, dtype=np.int64)
+            )
+
+    def files(self) -> dict:
+        if self.float_store is None:
+            return {}
+
+        return {"float_store": self.float_store.path.name}
+
+    def restore(
+        self, index: faiss.Index, read_only: bool = False, files: dict | None = None
+    ) -> None:
+        super().restore(index, read_only, files)
+
+        if self.float_store is not None and files and "float_store" in files:
+            self.float_store = FloatVectorStore(
+                str(self.float_store.path.with_name(files["float_store"])), self.d
+            )
+
+    def __rerank(
+        self, vectors: np.ndarray, candidates: np.ndarray, k: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        distances = np.full((len(vectors), k), np.inf, dtype=np.float32)
+        indices = np.full((len(vectors), k), -1, dtype=np.int64)
+
+        for row, (vector, row_candidates) in enumerate(zip(vectors, candidates)):
+            row_candidates = row_candidates[row_candidates >= 0]
+            exact = np.sum(
+                (self.float_store.get(row_candidates) - vector) ** 2, axis=1
+            )
+            order = np.argsort(exact)[:k]
+
+            distances[row, : len(order)] = exact[order]
+            indices[row, : len(order)] = row_candidates[order]
+
+        return distances, indices
+
+    def __search_codes(
+        self, vectors: np.ndarray, k: int, exclude: np.ndarray | None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """k-NN over the codes without the excluded ids.
+
+        IndexPQ takes no search parameters and so no selector, more neighbours
+        than needed are fetched instead and the excluded ones dropped.
+        """
+        if (
+            self.codec != "pq"
+            or not self.is_trained
+            or self.ntotal == 0
+            or exclude is None
+            or len(exclude) == 0
+        ):
+            return super().search(vectors, k, exclude=exclude)
+
+        fetch = min(2 * k, self.ntotal)
+        while True:
+            distances, indices = super().search(vectors, fetch)
+            kept = (indices >= 0) & ~np.isin(indices, exclude)
+            if fetch >= self.ntotal or kept.sum(axis=1).min() >= k:
+                break
+
+            fetch = min(2 * fetch, self.ntotal)
+
+        kept_distances = np.full((len(vectors), k), np.inf, dtype=np.float32)
+        kept_indices = np.full((len(vectors), k), -1, dtype=np.int64)
+        for row in range(len(vectors)):
+            columns = np.flatnonzero(kept[row])[:k]
+            kept_distances[row, : len(columns)] = distances[row, columns]
+            kept_indices[row, : len(columns)] = indices[row, columns]
+
+        return kept_distances, kept_indices
+
+    def search(
+        self,
+        vectors: np.ndarray,
+        k: int,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        exclude: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        if self.float_store is None or self.rerank_factor <= 1:
+            return self.__search_codes(vectors, k, exclude)
+
+        _, candidates = self.__search_codes(vectors, k * self.rerank_factor, exclude)
+
+        return self.__rerank(vectors, candidates, k)
+
+    def range_search(
+        self,
+        vector: np.ndarray,
+        radius: float,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        exclude: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Not every codec has a native range search, the k of a k-NN search
+        is doubled until the farthest candidate falls outside of a widened
+        radius, the candidates are then filtered by their exact distance"""
+        k = min(64, self.ntotal)
+        while True:
+            distances, candidates = self.__search_codes(vector, k, exclude)
+            distances, candidates = distances[0], candidates[0]
+
+            if k >= self.ntotal or distances[-1] >= 1.2 * radius:
+                break
+
+            k = min(2 * k, self.ntotal)
+
+        candidates = candidates[candidates >= 0]
+        if self.float_store is not None:
+            distances = np.sum(
+                (self.float_store.get(candidates) - vector[0]) ** 2, axis=1
+            )
+        else:
+            distances = distances[: len(candidates)]
+        within = distances < radius
+
+        return distances[within], candidates[within]
+
+
+INDEX_BACKENDS = {
+    backend.name: backend
+    for backend in (FlatBackend, IVFFlatBackend, HNSWBackend, CompressedBackend)
+}
+
+
+def make_index_backend(name: str, dimension: int, **options) -> IndexBackend:
+    if name not in INDEX_BACKENDS:
+        raise ValueError(
+            f"Unknown index backend {name}, choose one of {list(INDEX_BACKENDS)}."
+        )
+
+    return INDEX_BACKENDS[name](dimension, **options)
@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Callable
+
+import threading
+import time
+import uuid
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class Job:
+    id: str
+    filename: str
+    status: JobStatus = JobStatus.QUEUED
+    # current ingestion stage, e.g. parsing, chunking or embedding
+    stage: str = "queued"
+    # progress of the current stage in [0, 1]
+    progress: float = 0.0
+    error: str | None = None
+    # name of the known document the uploaded file is identical to
+    duplicate_of: str | None = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    """Runs ingestion jobs on a bounded pool of worker threads.
+
+    The worker is called with the job's file path, the name of the uploaded file
+    and a progress callback `progress(stage, fraction)`, and returns the name of
+    the known document the file duplicates, if any. At most `max_pending` jobs may wait or run at the
+    same time, and only the last `max_finished` finished jobs are remembered.
+    """
+
+    def __init__(
+        self,
+        worker: Callable[[str, str, Callable[[str, float], None]], str | None],
+        max_workers: int = 2,
+        max_pending: int = 32,
+        max_finished: int = 1000,
+    ):
+        self.worker = worker
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ingestion"
+        )
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def submit(self, path: str, filename: str) -> Job:
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise QueueFullError(
+                    f"There are already {self.pending} ingestion jobs in the queue."
+                )
+
+            job = Job(id=uuid.uuid4().hex, filename=filename)
+            self.jobs[job.id] = job
+            self.pending += 1
+
+        self.executor.submit(self.__run, job, path)
+
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self.jobs.get(job_id)
+
+    def __run(self, job: Job, path: str) -> None:
+        job.status = JobStatus.RUNNING
+
+        def progress(stage: str, fraction: float) -> None:
+            job.stage = stage
+            job.progress = fraction
+
+        try:
+            job.duplicate_of = self.worker(path, job.filename, progress)
+            job.status = JobStatus.DONE
+            progress("done", 1.0)
+        except Exception as e:
+            job.status = JobStatus.FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+
+            with self.lock:
+                self.pending -= 1
+                self.__forget_finished()
+
+    def __forget_finished(self) -> None:
+        finished = [
+            job_id
+            for job_id, job in self.jobs.items()
+            if job.finished_at is not None
+        ]
+        for job_id in finished[: max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
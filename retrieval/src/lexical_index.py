@@ -0,0 +1,181 @@
+from collections import defaultdict
+from typing import Iterable
+
+import numpy as np
+
+import math
+import pickle
+import re
+
+
+TERM_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    return TERM_PATTERN.findall(text.lower())
+
+
+class LexicalIndex:
+    """Positional inverted index over the chunks with BM25 ranking.
+
+    Every term maps to its postings, chunk id -> positions of the term in the
+    chunk. A query only touches the postings of its own terms, phrases are
+    matched by intersecting the postings of their terms, rarest first, and
+    comparing positions.
+
+    The index only grows while it is searched: chunks are dropped by building a
+    new index, searches filter out the chunks they must not see.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+
+        self.postings: dict[str, dict[int, list[int]]] = defaultdict(dict)
+        self.chunk_lengths: dict[int, int] = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.chunk_lengths)
+
+    def add(self, chunk_ids: Iterable[int], texts: Iterable[str]) -> None:
+        for chunk_id, text in zip(chunk_ids, texts):
+            terms = tokenize(text)
+            # the length goes first, searches run concurrently with adds
+            self.chunk_lengths[chunk_id] = len(terms)
+            self.total_length += len(terms)
+
+            for position, term in enumerate(terms):
+                self.postings[term].setdefault(chunk_id, []).append(position)
+
+    def reset(self) -> None:
+        self.postings.clear()
+        self.chunk_lengths.clear()
+        self.total_length = 0
+
+    def __idf(self, term: str) -> float:
+        document_frequency = len(self.postings.get(term, ()))
+
+        return math.log(
+            1 + (len(self) - document_frequency + 0.5) / (document_frequency + 0.5)
+        )
+
+    def __score(self, terms: list[str], chunk_ids: Iterable[int] | None = None) -> dict:
+        # the total length may lag behind a concurrent add, it is never 0 for
+        # chunks that have postings
+        average_length = self.total_length / max(len(self), 1) or 1.0
+        scores = defaultdict(float)
+
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+
+            idf = self.__idf(term)
+            candidates = list(postings) if chunk_ids is None else chunk_ids
+            for chunk_id in candidates:
+                positions = postings.get(chunk_id)
+                if positions is None:
+                    continue
+
+                frequency = len(positions)
+                normalization = self.k1 * (
+                    1 - self.b + self.b * self.chunk_lengths[chunk_id] / average_length
+                )
+                scores[chunk_id] += (
+                    idf * frequency * (self.k1 + 1) / (frequency + normalization)
+                )
+
+        return scores
+
+    @staticmethod
+    def __ranked(scores: dict, top_k: int | None) -> tuple[np.ndarray, np.ndarray]:
+        ranking = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        if top_k is not None:
+            ranking = ranking[:top_k]
+
+        chunk_ids = np.array([chunk_id for chunk_id, _ in ranking], dtype=np.int64)
+        values = np.array([score for _, score in ranking], dtype=np.float32)
+
+        return chunk_ids, values
+
+    def __containing_all(self, terms: list[str]) -> set[int]:
+        postings = [self.postings.get(term) for term in set(terms)]
+        if not postings or any(not posting for posting in postings):
+            return set()
+
+        postings.sort(key=len)
+        chunk_ids = set(postings[0])
+        for posting in postings[1:]:
+            chunk_ids.intersection_update(posting)
+            if not chunk_ids:
+                break
+
+        return chunk_ids
+
+    def __positions(self, term: str, chunk_id: int) -> list[int]:
+        # a chunk being added may not have the postings of all its terms yet
+        return self.postings.get(term, {}).get(chunk_id, [])
+
+    def __has_phrase(self, terms: list[str], chunk_id: int) -> bool:
+        starts = set(self.__positions(terms[0], chunk_id))
+        for offset, term in enumerate(terms[1:], start=1):
+            starts.intersection_update(
+                position - offset for position in self.__positions(term, chunk_id)
+            )
+            if not starts:
+                return False
+
+        return True
+
+    def search(
+        self, query: str, top_k: int | None = 10
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Chunks containing any of the query terms, best BM25 scores first"""
+        return self.__ranked(self.__score(tokenize(query)), top_k)
+
+    def search_phrase(
+        self, phrase: str, top_k: int | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Chunks containing the terms of the phrase in a row, best BM25 scores first"""
+        terms = tokenize(phrase)
+        chunk_ids = [
+            chunk_id
+            for chunk_id in self.__containing_all(terms)
+            if self.__has_phrase(terms, chunk_id)
+        ]
+
+        return self.__ranked(self.__score(terms, chunk_ids), top_k)
+
+    def search_keywords(
+        self, query: str, top_k: int | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Chunks containing every term of the query, best BM25 scores first"""
+        terms = tokenize(query)
+
+        return self.__ranked(self.__score(terms, self.__containing_all(terms)), top_k)
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            pickle.dump(
+                {
+                    "k1": self.k1,
+                    "b": self.b,
+                    "postings": dict(self.postings),
+                    "chunk_lengths": self.chunk_lengths,
+                },
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+
+        index = cls(state["k1"], state["b"])
+        index.postings.update(state["postings"])
+        index.chunk_lengths = state["chunk_lengths"]
+        index.total_length = sum(index.chunk_lengths.values())
+
+        return index
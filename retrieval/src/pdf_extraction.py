@@ -0,0 +1,92 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+import multiprocessing
+import threading
+
+import pypdfium2 as pdfium
+
+
+# pools are kept alive between documents, starting the workers is not free
+_pools: dict[int, ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+# PDFium is not thread-safe, not even for different documents, so the
+# ingestion threads of this process call it one at a time
+_pdfium_lock = threading.Lock()
+
+
+def _get_pool(num_workers: int) -> ProcessPoolExecutor:
+    with _pools_lock:
+        if num_workers not in _pools:
+            # the serving process runs torch threads, forking it is not safe
+            _pools[num_workers] = ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+        return _pools[num_workers]
+
+
+def count_pages(path: str) -> int:
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+
+def _page_text(pdf: pdfium.PdfDocument, idx: int) -> str:
+    # pages are closed right away instead of by the garbage collector, which
+    # may run in any thread
+    page = pdf.get_page(idx)
+    try:
+        textpage = page.get_textpage()
+        try:
+            return textpage.get_text_bounded()
+        finally:
+            textpage.close()
+    finally:
+        page.close()
+
+
+def extract_page_range(path: str, start: int, stop: int) -> list[str]:
+    """Extracts the text of pages [start, stop) with a separately opened document"""
+    pdf = pdfium.PdfDocument(path)
+    try:
+        return [_page_text(pdf, idx) for idx in range(start, stop)]
+    finally:
+        pdf.close()
+
+
+def iter_pages(
+    path: str, num_workers: int = 1, pages_per_task: int = 32
+) -> Iterator[str]:
+    """Yields the text of every page in order.
+
+    With more than one worker, page ranges are extracted by a process pool and
+    yielded as soon as all preceding ranges are done.
+    """
+    if num_workers <= 1:
+        # the lock is not held while the caller processes a page
+        with _pdfium_lock:
+            pdf = pdfium.PdfDocument(path)
+            num_pages = len(pdf)
+        try:
+            for idx in range(num_pages):
+                with _pdfium_lock:
+                    text = _page_text(pdf, idx)
+                yield text
+        finally:
+            with _pdfium_lock:
+                pdf.close()
+        return
+
+    num_pages = count_pages(path)
+    starts = range(0, num_pages, pages_per_task)
+    stops = [min(start + pages_per_task, num_pages) for start in starts]
+
+    pool = _get_pool(num_workers)
+    for pages in pool.map(extract_page_range, [path] * len(starts), starts, stops):
+        yield from pages
@@ -0,0 +1,409 @@
+from src.chunk_storage import Chunk, ChunkTable, Document
+from src.index_backends import IndexBackend
+from src.lexical_index import LexicalIndex
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Iterator, Sequence
+
+import numpy as np
+import faiss
+
+import json
+import os
+import pickle
+import shutil
+import struct
+import zlib
+
+
+GENERATIONS_DIRECTORY = "generations"
+# name of the generation readers have to load, replaced atomically
+CURRENT_FILE = "CURRENT"
+WAL_FILE = "wal.log"
+
+# every WAL record is prefixed with its payload length and crc32 checksum
+WAL_HEADER = struct.Struct("<QI")
+
+
+def _directory_size(directory: Path) -> int:
+    return sum(path.stat().st_size for path in directory.iterdir() if path.is_file())
+
+
+class StringColumn:
+    """Read-only column of strings stored as one utf-8 blob plus offsets"""
+
+    def __init__(self, directory: Path, name: str):
+        self.blob = np.load(directory / f"{name}.npy", mmap_mode="r")
+        self.offsets = np.load(directory / f"{name}_offsets.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        return bytes(self.blob[start:stop]).decode("utf-8")
+
+    @staticmethod
+    def write(directory: Path, name: str, strings: Iterator[str]) -> None:
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(item) for item in encoded], out=offsets[1:])
+
+        np.save(directory / f"{name}.npy", np.frombuffer(b"".join(encoded), np.uint8))
+        np.save(directory / f"{name}_offsets.npy", offsets)
+
+
+class RaggedColumn:
+    """Read-only column of variable-length integer arrays"""
+
+    def __init__(self, directory: Path, name: str):
+        self.values = np.load(directory / f"{name}.npy", mmap_mode="r")
+        self.offsets = np.load(directory / f"{name}_offsets.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.values[self.offsets[index] : self.offsets[index + 1]]
+
+    @staticmethod
+    def write(directory: Path, name: str, arrays: list[Sequence[int]]) -> None:
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(array) for array in arrays], out=offsets[1:])
+
+        values = np.empty(offsets[-1], dtype=np.int32)
+        for index, array in enumerate(arrays):
+            values[offsets[index] : offsets[index + 1]] = array
+
+        np.save(directory / f"{name}.npy", values)
+        np.save(directory / f"{name}_offsets.npy", offsets)
+
+
+class ColumnSlice:
+    """View of a contiguous range of a column, used for the pages of a document"""
+
+    def __init__(self, column: StringColumn, start: int, stop: int):
+        self.column = column
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+
+        return self.column[self.start + index]
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(self.start, self.stop):
+            yield self.column[index]
+
+
+class ChunkColumns:
+    """Chunks of a snapshot, materialized on access from memory-mapped columns"""
+
+    def __init__(self, directory: Path, document_names: list[str]):
+        self.texts = StringColumn(directory, "chunk_texts")
+        self.input_ids = RaggedColumn(directory, "chunk_input_ids")
+        self.positions = np.load(directory / "chunk_positions.npy", mmap_mode="r")
+        self.document_ids = np.load(
+            directory / "chunk_document_ids.npy", mmap_mode="r"
+        )
+        self.document_names = document_names
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index: int) -> Chunk:
+        return Chunk(
+            self.texts[index],
+            int(self.positions[index]),
+            self.document_names[self.document_ids[index]],
+            self.input_ids[index].tolist(),
+        )
+
+
+@dataclass
+class StoredState:
+    index: faiss.Index | None
+    chunks: ChunkTable
+    documents: list[Document]
+    # None when the snapshot is loaded without its indexes
+    lexical_index: LexicalIndex | None = None
+    # ids of the documents deleted since the last compaction
+    deleted_documents: list[int] = field(default_factory=list)
+    generation: str | None = None
+    # files next to the index that it was saved with, see IndexBackend.files
+    index_files: dict = field(default_factory=dict)
+
+
+class IndexStore:
+    """Snapshots the index, chunks and documents to disk and logs every change.
+
+    A snapshot is a directory of columnar files that is loaded memory-mapped.
+    Adds and deletions made after the last snapshot are appended to a write-ahead
+    log, so they are replayed instead of being re-embedded after a restart.
+
+    Every snapshot is written as a new generation directory and published by
+    replacing the CURRENT file, so that reader processes sharing the directory
+    switch from one complete generation to the next and follow the log in
+    between.
+    """
+
+    def __init__(
+        self, directory: str, snapshot_every: int = 50, snapshot_growth: float = 0.25
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.snapshot_every = snapshot_every
+        self.snapshot_growth = snapshot_growth
+
+        self.sequence = 0
+        self.snapshot_sequence = 0
+        # size of the files of the current generation
+        self.snapshot_bytes = 0
+
+        # where a follower stopped reading the log, and which log file it was
+        self.wal_position = 0
+        self.wal_inode = None
+
+    @property
+    def generations_directory(self) -> Path:
+        return self.directory / GENERATIONS_DIRECTORY
+
+    def current_generation(self) -> str | None:
+        try:
+            return (self.directory / CURRENT_FILE).read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def __publish(self, generation: str) -> None:
+        temporary_path = self.directory / f"{CURRENT_FILE}.tmp"
+        with open(temporary_path, "w") as f:
+            f.write(generation)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temporary_path, self.directory / CURRENT_FILE)
+
+    @property
+    def wal_path(self) -> Path:
+        return self.directory / WAL_FILE
+
+    def should_snapshot(self) -> bool:
+        """Whether the log has grown enough to be folded into a new snapshot.
+
+        A snapshot rewrites the whole database, so besides `snapshot_every`
+        records the log has to reach `snapshot_growth` of the snapshot size:
+        the cost of the snapshots per added document stays the same as the
+        database grows.
+        """
+        if self.sequence - self.snapshot_sequence < self.snapshot_every:
+            return False
+
+        try:
+            wal_bytes = self.wal_path.stat().st_size
+        except FileNotFoundError:
+            return False
+
+        return wal_bytes >= self.snapshot_growth * self.snapshot_bytes
+
+    def __append(self, record: dict) -> None:
+        self.sequence += 1
+        payload = pickle.dumps(
+            {"sequence": self.sequence, **record}, protocol=pickle.HIGHEST_PROTOCOL
+        )
+
+        with open(self.wal_path, "ab") as wal:
+            wal.write(WAL_HEADER.pack(len(payload), zlib.crc32(payload)))
+            wal.write(payload)
+            wal.flush()
+            os.fsync(wal.fileno())
+
+    def log_add(
+        self, document: Document, chunks: list[Chunk], embeddings: np.ndarray
+    ) -> None:
+        """Durably appends a document add to the write-ahead log"""
+        self.__append(
+            {
+                "op": "add",
+                "name": document.name,
+                "content_hash": document.content_hash,
+                "pages": list(document.pages),
+                "chunks": [
+                    (chunk.text, chunk.id, list(chunk.input_ids)) for chunk in chunks
+                ],
+                "embeddings": embeddings,
+            }
+        )
+
+    def log_delete(self, name: str) -> None:
+        """Durably appends a document deletion to the write-ahead log"""
+        self.__append({"op": "delete", "name": name})
+
+    def read_wal(self, follow: bool = False) -> Iterator[dict]:
+        """Yields the logged changes that are not part of the snapshot yet.
+
+        Reading stops at the first torn or corrupted record. With `follow` the
+        reading continues where the previous call stopped, a record that is
+        still being written is picked up by the next call.
+        """
+        try:
+            wal = open(self.wal_path, "rb")
+        except FileNotFoundError:
+            return
+
+        with wal:
+            inode = os.fstat(wal.fileno()).st_ino
+            if follow and inode == self.wal_inode:
+                wal.seek(min(self.wal_position, os.fstat(wal.fileno()).st_size))
+            self.wal_inode = inode
+            self.wal_position = wal.tell()
+
+            while header := wal.read(WAL_HEADER.size):
+                if len(header) < WAL_HEADER.size:
+                    break
+
+                length, checksum = WAL_HEADER.unpack(header)
+                payload = wal.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    break
+
+                record = pickle.loads(payload)
+                if follow and record["sequence"] > self.sequence + 1:
+                    # the log was truncated by a snapshot that is not loaded yet
+                    break
+
+                self.wal_position = wal.tell()
+                if record["sequence"] > max(self.sequence, self.snapshot_sequence):
+                    self.sequence = record["sequence"]
+                    yield record
+
+    def save(
+        self,
+        index: IndexBackend,
+        chunks: ChunkTable,
+        documents: list[Document],
+        lexical_index: LexicalIndex,
+        deleted_documents: Iterable[int] = (),
+    ) -> None:
+        """Writes a new snapshot generation and truncates the write-ahead log"""
+        previous_generation = self.current_generation()
+        generation = f"{int(previous_generation or 0) + 1:012d}"
+
+        self.generations_directory.mkdir(exist_ok=True)
+        temporary_directory = self.generations_directory / f"{generation}.tmp"
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        temporary_directory.mkdir()
+
+        faiss.write_index(index.index, str(temporary_directory / "index.faiss"))
+        lexical_index.save(str(temporary_directory / "lexical_index.pkl"))
+
+        document_names = [document.name for document in documents]
+
+        StringColumn.write(
+            temporary_directory, "chunk_texts", (chunk.text for chunk in chunks)
+        )
+        RaggedColumn.write(
+            temporary_directory,
+            "chunk_input_ids",
+            [chunk.input_ids for chunk in chunks],
+        )
+        np.save(
+            temporary_directory / "chunk_positions.npy",
+            np.array([chunk.id for chunk in chunks], dtype=np.int32),
+        )
+        # a replaced document keeps its id next to the new version of the same
+        # name, so the ids are taken from the table and not from the names
+        np.save(
+            temporary_directory / "chunk_document_ids.npy",
+            chunks.document_ids(np.arange(len(chunks))),
+        )
+
+        StringColumn.write(
+            temporary_directory,
+            "page_texts",
+            (page for document in documents for page in document.pages),
+        )
+        page_offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+        np.cumsum([len(document) for document in documents], out=page_offsets[1:])
+        np.save(temporary_directory / "document_page_offsets.npy", page_offsets)
+
+        with open(temporary_directory / "documents.json", "w") as f:
+            json.dump(
+                {
+                    "sequence": self.sequence,
+                    "documents": document_names,
+                    "content_hashes": [
+                        document.content_hash for document in documents
+                    ],
+                    "deleted": sorted(deleted_documents),
+                    "index_files": index.files(),
+                },
+                f,
+            )
+
+        # the generation is complete on disk before it gets published
+        snapshot_bytes = _directory_size(temporary_directory)
+        os.replace(temporary_directory, self.generations_directory / generation)
+        self.__publish(generation)
+
+        self.snapshot_sequence = self.sequence
+        self.snapshot_bytes = snapshot_bytes
+        self.wal_path.unlink(missing_ok=True)
+
+        # Readers may still be loading the previous generation, older ones are
+        # removed. Files a reader has already mapped stay readable after that.
+        for directory in self.generations_directory.iterdir():
+            if directory.name not in (generation, previous_generation):
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def load(self, with_index: bool = True) -> StoredState | None:
+        """Loads the latest snapshot memory-mapped, if there is one"""
+        generation = self.current_generation()
+        if generation is None:
+            return None
+        directory = self.generations_directory / generation
+
+        with open(directory / "documents.json") as f:
+            registry = json.load(f)
+
+        self.sequence = self.snapshot_sequence = registry["sequence"]
+        self.snapshot_bytes = _directory_size(directory)
+        # the log of the loaded snapshot is read from its start
+        self.wal_inode = None
+        document_names = registry["documents"]
+        content_hashes = registry["content_hashes"]
+
+        index = None
+        lexical_index = None
+        if with_index:
+            index = faiss.read_index(
+                str(directory / "index.faiss"), faiss.IO_FLAG_MMAP
+            )
+            lexical_index = LexicalIndex.load(str(directory / "lexical_index.pkl"))
+        columns = ChunkColumns(directory, document_names)
+        chunks = ChunkTable(columns, columns.document_ids)
+
+        pages = StringColumn(directory, "page_texts")
+        page_offsets = np.load(directory / "document_page_offsets.npy")
+        documents = [
+            Document.from_pages(
+                name,
+                ColumnSlice(pages, int(page_offsets[idx]), int(page_offsets[idx + 1])),
+                content_hashes[idx],
+            )
+            for idx, name in enumerate(document_names)
+        ]
+
+        return StoredState(
+            index,
+            chunks,
+            documents,
+            lexical_index,
+            registry["deleted"],
+            generation,
+            registry["index_files"],
+        )
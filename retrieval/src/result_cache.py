@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from typing import Any, Hashable
+
+import threading
+
+
+class ResultCache:
+    """LRU cache of search results tagged with the version of the database.
+
+    An entry only answers lookups made against the version it was computed
+    from, so a change of the database invalidates every entry at once without
+    touching them. Stale entries are dropped when they are looked up or evicted.
+    """
+
+    def __init__(self, capacity: int = 10_000):
+        self.capacity = capacity
+
+        # key -> (version, result)
+        self.entries: OrderedDict[Hashable, tuple[int, Any]] = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, version: int) -> Any | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry[0] != version:
+                del self.entries[key]
+                self.stale += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, version: int, result: Any) -> None:
+        if self.capacity <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (version, result)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale + self.misses
+
+        return {
+            "entries": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            # misses of entries computed before the last change
+            "stale": self.stale,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,118 +1,908 @@
-from transformers import AutoTokenizer, AutoModel
-from src.chunk_storage import ChunkStorage, Document
+from transformers import AutoTokenizer
+from src.chunk_storage import Chunk, Chunker, ChunkTable, Document
+from src.persistence import IndexStore
+from src.embedding_cache import EmbeddingCache
+from src.index_backends import FlatBackend, IndexBackend, make_index_backend
+from src.embedding_backends import make_embedding_backend
+from src.embedding_batcher import EmbeddingBatcher
+from src.result_cache import ResultCache
+from src.lexical_index import LexicalIndex
 
-import torch
-import faiss
+from dataclasses import dataclass, replace
+from typing import Callable
 
+import numpy as np
+
+import itertools
 import os
+import threading
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "True"
 
 
+# constant of the reciprocal rank fusion of the lexical and dense rankings
+RRF_K = 60
+
+SEARCH_MODES = ("lexical", "dense", "hybrid")
+
+
+class ReadOnlyError(Exception):
+    """Raised when a reader engine is asked to change the database"""
+
+
+def _ignore_progress(stage: str, fraction: float) -> None:
+    pass
+
+
+def _unique_in_order(values: np.ndarray) -> np.ndarray:
+    _, first_positions = np.unique(values, return_index=True)
+
+    return values[np.sort(first_positions)]
+
+
+@dataclass(frozen=True)
+class EngineState:
+    """Everything a search reads, published as a whole and never changed.
+
+    Changes build the next state next to the current one and publish it by
+    replacing `RetrievalEngine.state`, a search keeps using the state it
+    started with. The chunk table and the lexical index are append-only and
+    shared by consecutive states, `num_chunks` bounds what belongs to this one.
+    Deleted chunks keep their postings until compaction and are filtered by
+    `deleted_chunks`, so a shared structure never loses what a state relies on.
+    """
+
+    index: IndexBackend
+    # vectors added since `index` was copied, searched next to it
+    recent: IndexBackend
+    chunks: ChunkTable
+    num_chunks: int
+    lexical_index: LexicalIndex
+    # name -> document of the documents in the database
+    documents: dict
+    # document id -> name, deleted documents keep their ids until compaction
+    document_names: tuple
+    # name -> id of the documents in the database
+    document_ids: dict
+    # content hash -> name of every document in the database
+    content_hashes: dict
+    deleted_documents: frozenset
+    deleted_chunks: np.ndarray
+    generation: str | None = None
+    # changes with every add, deletion, reset or reload, never reused
+    version: int = 0
+
+
+@dataclass
+class SearchResult:
+    chunk_id: int
+    # name of the chunk's document
+    document: str
+    # cosine similarity of the normalized embeddings, higher is closer
+    score: float
+    text: str
+
+
 class RetrievalEngine:
-    def __init__(self, model_id: str = "sentence-transformers/all-MiniLM-L6-v2"):
+    def __init__(
+        self,
+        model_id: str = "sentence-transformers/all-MiniLM-L6-v2",
+        batch_size: int = 32,
+        data_directory: str | None = None,
+        snapshot_every: int = 50,
+        snapshot_growth: float = 0.25,
+        extraction_workers: int = 1,
+        embedding_cache_size: int = 100_000,
+        embedding_cache_directory: str | None = None,
+        index_backend: str = "flat",
+        index_options: dict | None = None,
+        compaction_threshold: float = 0.25,
+        embedding_backend: str = "torch",
+        embedding_options: dict | None = None,
+        read_only: bool = False,
+        recent_capacity: int = 4096,
+        query_batch_size: int = 32,
+        query_batch_wait_ms: float = 2.0,
+        result_cache_size: int = 10_000,
+    ):
+        self.batch_size = batch_size
+        self.extraction_workers = extraction_workers
         self.tokenizer = AutoTokenizer.from_pretrained(model_id)
-        self.model = AutoModel.from_pretrained(model_id)
-        self.model.eval()
+        self.embedder = make_embedding_backend(
+            embedding_backend, model_id, **(embedding_options or {})
+        )
+
+        self.index_backend = index_backend
+        self.index_options = index_options or {}
+        self.chunker = Chunker(self.tokenizer)
+        self.duplicate_uploads = 0
+
+        # Deleted documents are tombstoned: their chunk ids are excluded from
+        # the searches and reclaimed once they make up `compaction_threshold`
+        # of all chunks
+        self.compaction_threshold = compaction_threshold
+        self.compacting = False
 
-        self.index = faiss.IndexFlatL2(
-            self.model.embeddings.word_embeddings.embedding_dim
+        # New vectors are added to a copy of the small index of recent vectors,
+        # which is folded into a copy of the main index above this size
+        self.recent_capacity = recent_capacity
+
+        self.embedding_cache = EmbeddingCache(
+            self.embedder.cache_id, embedding_cache_size, embedding_cache_directory
+        )
+        # results of repeated searches, valid for the state version they came from
+        self.result_cache = ResultCache(result_cache_size)
+        # the prompts of concurrent searches are embedded together
+        self.query_batcher = EmbeddingBatcher(
+            self.__embed_texts, query_batch_size, query_batch_wait_ms
+        )
+
+        # serializes the changes, parsing and embedding of concurrent adds run
+        # outside of it and searches never take it
+        self.write_lock = threading.RLock()
+
+        self.versions = itertools.count()
+        self.state = self.__make_state(
+            make_index_backend(
+                index_backend, self.embedder.dimension, **self.index_options
+            ),
+            ChunkTable(),
+            LexicalIndex(),
+            [],
+        )
+
+        # A read-only engine follows the snapshots and the log written by the
+        # engine of another process on the same data directory
+        self.read_only = read_only
+
+        self.store = None
+        if data_directory is not None:
+            self.store = IndexStore(data_directory, snapshot_every, snapshot_growth)
+            self.__restore()
+
+    def __make_state(
+        self,
+        index: IndexBackend,
+        chunks: ChunkTable,
+        lexical_index: LexicalIndex,
+        documents: list[Document],
+        deleted_documents: list[int] = (),
+        generation: str | None = None,
+    ) -> EngineState:
+        """State of documents listed by id, e.g. the ones of a snapshot"""
+        deleted_documents = frozenset(deleted_documents)
+        live = [
+            (document_id, document)
+            for document_id, document in enumerate(documents)
+            if document_id not in deleted_documents
+        ]
+
+        ranges = [
+            chunks.document_range(document_id)
+            for document_id in sorted(deleted_documents)
+        ]
+        deleted_chunks = np.array(
+            [chunk_id for start, stop in ranges for chunk_id in range(start, stop)],
+            dtype=np.int64,
         )
-        self.chunk_storage = ChunkStorage(model_id)
-        self.documents = []
 
-    def __get_embeddings(self, text: str) -> torch.Tensor:
+        return EngineState(
+            index=index,
+            recent=FlatBackend(self.embedder.dimension),
+            chunks=chunks,
+            num_chunks=len(chunks),
+            lexical_index=lexical_index,
+            documents={document.name: document for _, document in live},
+            document_names=tuple(document.name for document in documents),
+            document_ids={
+                document.name: document_id for document_id, document in live
+            },
+            content_hashes={
+                document.content_hash: document.name
+                for _, document in live
+                if document.content_hash is not None
+            },
+            deleted_documents=deleted_documents,
+            deleted_chunks=deleted_chunks,
+            generation=generation,
+            version=next(self.versions),
+        )
+
+    @staticmethod
+    def __document_table(state: EngineState) -> list[Document]:
+        """Documents by id, deleted ones are kept as empty placeholders"""
+        return [
+            Document.from_pages(name, [])
+            if document_id in state.deleted_documents
+            else state.documents[name]
+            for document_id, name in enumerate(state.document_names)
+        ]
+
+    def __load_generation(self) -> None:
+        """Swaps in the last snapshot, loaded next to the state being served"""
+        state = self.store.load()
+
+        index = make_index_backend(
+            self.index_backend, self.embedder.dimension, **self.index_options
+        )
+        if state is None:
+            lexical_index = LexicalIndex(
+                self.state.lexical_index.k1, self.state.lexical_index.b
+            )
+            with self.write_lock:
+                self.state = self.__make_state(index, ChunkTable(), lexical_index, [])
+            return
+
+        index.restore(state.index, read_only=True, files=state.index_files)
+
+        with self.write_lock:
+            self.state = self.__make_state(
+                index,
+                state.chunks,
+                state.lexical_index,
+                state.documents,
+                state.deleted_documents,
+                state.generation,
+            )
+
+    def __apply(self, state: EngineState, record: dict) -> EngineState:
+        """Applies a change read from the write-ahead log"""
+        if record.get("op") == "delete":
+            if record["name"] in state.documents:
+                state = self.__without_document(state, record["name"])
+            return state
+
+        document = Document.from_pages(
+            record["name"], record["pages"], record.get("content_hash")
+        )
+        chunks = [
+            Chunk(text, position, document.name, input_ids)
+            for text, position, input_ids in record["chunks"]
+        ]
+
+        return self.__with_document(state, document, chunks, record["embeddings"])
+
+    def __apply_wal(self) -> bool:
+        with self.write_lock:
+            state = self.state
+            for record in self.store.read_wal(follow=True):
+                state = self.__apply(state, record)
+
+            changed = state is not self.state
+            self.state = state
+
+        return changed
+
+    def __restore(self) -> None:
+        """Loads the last snapshot and replays the changes logged after it"""
+        self.__load_generation()
+        self.__apply_wal()
+
+    def refresh(self) -> bool:
+        """Catches up with the writer of the data directory.
+
+        A newly published snapshot generation is loaded and swapped in, then the
+        changes logged after it are applied. Returns True when anything changed.
+        """
+        if self.store is None:
+            return False
+
+        changed = False
+        if self.store.current_generation() != self.state.generation:
+            self.__load_generation()
+            changed = True
+
+        return self.__apply_wal() or changed
+
+    def __check_writable(self) -> None:
+        if self.read_only:
+            raise ReadOnlyError(
+                "This retrieval engine is a reader, changes go to the writer."
+            )
+
+    def snapshot(self) -> None:
+        """Persists the current state and drops the in-memory copies of it"""
+        if self.store is None or self.read_only:
+            return
+
+        with self.write_lock:
+            state = self.state
+            # A memory-mapped index refers to the file of an older generation,
+            # which is removed later on, so the snapshot gets an in-memory copy
+            if state.recent.ntotal > 0 or state.index.read_only:
+                state = self.__merged(state)
+
+            self.store.save(
+                state.index,
+                state.chunks,
+                self.__document_table(state),
+                state.lexical_index,
+                state.deleted_documents,
+            )
+
+            stored = self.store.load(with_index=False)
+            self.state = self.__make_state(
+                state.index,
+                stored.chunks,
+                state.lexical_index,
+                stored.documents,
+                stored.deleted_documents,
+                stored.generation,
+            )
+
+    def __merged(self, state: EngineState) -> EngineState:
+        """Folds the recent vectors into a copy of the main index"""
+        index = state.index.copy()
+        vectors, ids = state.recent.contents()
+        if len(ids) > 0:
+            index.add(vectors, ids)
+        if len(state.deleted_chunks) > 0:
+            index.remove(state.deleted_chunks)
+
+        return replace(state, index=index, recent=FlatBackend(self.embedder.dimension))
+
+    def __with_document(
+        self,
+        state: EngineState,
+        document: Document,
+        chunks: list[Chunk],
+        embeddings: np.ndarray,
+    ) -> EngineState:
+        """Next state with a document appended"""
+        document_id = len(state.document_names)
+        chunk_ids = np.arange(state.num_chunks, state.num_chunks + len(chunks))
+
+        # the shared table and lexical index only grow past what `state` covers
+        state.chunks.extend(chunks, document_id)
+        state.lexical_index.add(chunk_ids.tolist(), (chunk.text for chunk in chunks))
+
+        recent = state.recent
+        if len(chunks) > 0:
+            recent = recent.copy()
+            recent.add(embeddings, chunk_ids)
+
+        state = replace(
+            state,
+            recent=recent,
+            num_chunks=state.num_chunks + len(chunks),
+            documents={**state.documents, document.name: document},
+            document_names=state.document_names + (document.name,),
+            document_ids={**state.document_ids, document.name: document_id},
+            content_hashes={**state.content_hashes, document.content_hash: document.name},
+            version=next(self.versions),
+        )
+
+        if state.recent.ntotal >= self.recent_capacity:
+            state = self.__merged(state)
+
+        return state
+
+    def __without_document(self, state: EngineState, name: str) -> EngineState:
+        """Next state with a document tombstoned"""
+        document_id = state.document_ids[name]
+        document = state.documents[name]
+
+        start, stop = state.chunks.document_range(document_id)
+        chunk_ids = np.arange(start, stop)
+
+        return replace(
+            state,
+            documents={key: value for key, value in state.documents.items() if key != name},
+            document_ids={
+                key: value for key, value in state.document_ids.items() if key != name
+            },
+            content_hashes={
+                key: value
+                for key, value in state.content_hashes.items()
+                if key != document.content_hash
+            },
+            deleted_documents=state.deleted_documents | {document_id},
+            deleted_chunks=np.union1d(state.deleted_chunks, chunk_ids),
+            version=next(self.versions),
+        )
+
+    def __embed_texts(self, texts: list[str]) -> np.ndarray:
         encoded_input = self.tokenizer(
-            text, padding=True, truncation=True, return_tensors="pt"
+            texts, padding=True, truncation=True, return_tensors="np"
+        )
+
+        return self.__encode(encoded_input)
+
+    def __get_embeddings(self, text: str) -> np.ndarray:
+        return self.query_batcher.embed(text)[None]
+
+    def __normalize(self, text: str) -> str:
+        """Form of a prompt in the result cache keys"""
+        text = " ".join(text.split())
+        # the tokenizers of uncased models lowercase the text anyway
+        if getattr(self.tokenizer, "do_lower_case", False):
+            text = text.lower()
+
+        return text
+
+    def __lexical_query(self, text: str) -> str:
+        """A query in the form of the indexed chunk texts.
+
+        The chunk texts are decoded from token ids, so they went through the
+        normalizer of the tokenizer, e.g. lowercasing and accent stripping.
+        """
+        backend_tokenizer = getattr(self.tokenizer, "backend_tokenizer", None)
+        if backend_tokenizer is None or backend_tokenizer.normalizer is None:
+            return text
+
+        return backend_tokenizer.normalizer.normalize_str(text)
+
+    def __encode(self, encoded_input) -> np.ndarray:
+        # cls pooling of the token embeddings, normalized
+        return self.embedder.encode(
+            encoded_input["input_ids"], encoded_input["attention_mask"]
         )
 
-        # Compute token embeddings
-        with torch.no_grad():
-            model_output = self.model(**encoded_input)
-            # Perform pooling. In this case, cls pooling.
-            sentence_embeddings = model_output[0][:, 0]
+    def __get_embeddings_from_ids(
+        self,
+        input_ids: list[list[int]],
+        progress: Callable[[float], None] | None = None,
+        cache: bool = True,
+    ) -> np.ndarray:
+        """Embeds already tokenized chunks in length-bucketed batches.
 
-        # normalize embeddings
-        sentence_embeddings = torch.nn.functional.normalize(
-            sentence_embeddings, p=2, dim=1
+        Cached embeddings are reused, the remaining sequences are sorted by length
+        so that every batch is padded only up to its own longest sequence instead
+        of the model's maximum length.
+        """
+        embeddings = np.empty(
+            (len(input_ids), self.embedder.dimension), dtype=np.float32
         )
 
-        return sentence_embeddings
+        keys = [self.embedding_cache.key(ids) if cache else None for ids in input_ids]
+        missing = []
+        for position, key in enumerate(keys):
+            cached_embedding = self.embedding_cache.get(key) if cache else None
+            if cached_embedding is None:
+                missing.append(position)
+            else:
+                embeddings[position] = cached_embedding
+
+        order = sorted(missing, key=lambda idx: len(input_ids[idx]))
+
+        for start in range(0, len(order), self.batch_size):
+            batch_positions = order[start : start + self.batch_size]
+            encoded_input = self.tokenizer.pad(
+                {"input_ids": [input_ids[idx] for idx in batch_positions]},
+                padding=True,
+                return_tensors="np",
+            )
+
+            embeddings[batch_positions] = self.__encode(encoded_input)
+
+            if cache:
+                for position in batch_positions:
+                    self.embedding_cache.put(
+                        keys[position], embeddings[position].copy()
+                    )
+
+            if progress is not None:
+                progress(min(start + self.batch_size, len(order)) / len(order))
+
+        return embeddings
 
     def reset(self):
-        self.chunk_storage.reset()
-        self.index.reset()
+        self.__check_writable()
+
+        index = make_index_backend(
+            self.index_backend, self.embedder.dimension, **self.index_options
+        )
+        # a new backend may still find files of the old one, e.g. its float store
+        index.reset()
+
+        with self.write_lock:
+            self.state = self.__make_state(
+                index,
+                ChunkTable(),
+                LexicalIndex(self.state.lexical_index.k1, self.state.lexical_index.b),
+                [],
+            )
+
+            # an empty generation is published, so that readers drop theirs too
+            self.snapshot()
 
     def check_document(self, name: str) -> bool:
         """Checks that document is already in the database"""
-        if len(self.documents) == 0:
-            return False
+        return name in self.state.documents
+
+    def __duplicate_of(self, document: Document) -> str | None:
+        # an identical file is recognized by its hash before it is parsed, a
+        # new version of a known document replaces it
+        known_name = self.state.content_hashes.get(document.content_hash)
+        if known_name is not None:
+            self.duplicate_uploads += 1
 
-        for document in self.documents:
-            if name == document.name:
-                print(document.name, name)
-                return True
+        return known_name
 
-        return False
+    def delete_document(self, name: str) -> bool:
+        """Removes a document, returns False when there is no such document"""
+        self.__check_writable()
 
-    def add_document(self, path: str) -> None:
-        document = Document(path)
+        with self.write_lock:
+            if name not in self.state.documents:
+                return False
 
-        if not self.check_document(document.name):
-            self.documents.append(document)
-            self.chunk_storage.chunk_document(document)
+            if self.store is not None:
+                self.store.log_delete(name)
+            self.state = self.__without_document(self.state, name)
 
-            embeddings = []
-            for chunk in self.chunk_storage:
-                embeddings.append(self.__get_embeddings(chunk.text))
+            self.__schedule_compaction()
 
-            embeddings = torch.concat(embeddings, dim=0).data.cpu().numpy()
+        return True
+
+    def __schedule_compaction(self) -> None:
+        state = self.state
+        if self.compacting or self.read_only or state.num_chunks == 0:
+            return
+
+        if len(state.deleted_chunks) / state.num_chunks < self.compaction_threshold:
+            return
+
+        self.compacting = True
+        threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self) -> None:
+        """Drops the tombstoned documents and chunks and renumbers the rest.
+
+        Live chunks are copied into a new table, their vectors are moved to a
+        rebuilt index under the new ids, the new state is swapped in at once.
+        """
+        try:
+            with self.write_lock:
+                state = self.state
+                if len(state.deleted_documents) == 0:
+                    return
+
+                if state.recent.ntotal > 0:
+                    state = self.__merged(state)
+                vectors, ids = state.index.contents()
+
+                # old chunk id -> new chunk id, -1 for the dropped ones
+                new_ids = np.full(state.num_chunks, -1, dtype=np.int64)
+                new_chunks = ChunkTable()
+                documents = []
+                for document_id, name in enumerate(state.document_names):
+                    if document_id in state.deleted_documents:
+                        continue
+
+                    start, stop = state.chunks.document_range(document_id)
+                    new_ids[start:stop] = np.arange(
+                        len(new_chunks), len(new_chunks) + stop - start
+                    )
+                    new_chunks.extend(
+                        [state.chunks[chunk_id] for chunk_id in range(start, stop)],
+                        len(documents),
+                    )
+                    documents.append(state.documents[name])
+
+                kept = new_ids[ids] >= 0
+                lexical_index = LexicalIndex(
+                    state.lexical_index.k1, state.lexical_index.b
+                )
+                lexical_index.add(
+                    range(len(new_chunks)), (chunk.text for chunk in new_chunks)
+                )
+
+                self.state = self.__make_state(
+                    state.index.rebuilt(vectors[kept], new_ids[ids[kept]]),
+                    new_chunks,
+                    lexical_index,
+                    documents,
+                    generation=state.generation,
+                )
+
+                if self.store is not None:
+                    self.snapshot()
+        finally:
+            self.compacting = False
+
+    def add_document(
+        self,
+        path: str,
+        progress: Callable[[str, float], None] | None = None,
+        name: str | None = None,
+    ) -> str | None:
+        """Parses, chunks and embeds a document and appends it to the index.
+
+        The document is called `name`, the name of the file by default.
+        `progress(stage, fraction)` is called as the ingestion advances.
+        A file identical to a known document is not added again, the name of
+        that document is returned instead.
+        """
+        self.__check_writable()
+
+        if progress is None:
+            progress = _ignore_progress
+
+        document = Document(path, num_workers=self.extraction_workers, name=name)
+
+        if (duplicate_of := self.__duplicate_of(document)) is not None:
+            return duplicate_of
+
+        # pages are extracted lazily and chunked while they are being parsed
+        progress("parsing", 0.0)
+        new_chunks = self.chunker.chunk_document(document)
+
+        progress("embedding", 0.0)
+        embeddings = self.__get_embeddings_from_ids(
+            [chunk.input_ids for chunk in new_chunks],
+            progress=lambda fraction: progress("embedding", fraction),
+        )
 
-            # due to faiss architecture, we have to reset and rebuild index each time
-            self.index.reset()
-            self.index.add(embeddings)
+        progress("indexing", 0.0)
+        with self.write_lock:
+            # the same document may have been added while this one was embedded
+            if (duplicate_of := self.__duplicate_of(document)) is not None:
+                return duplicate_of
+
+            state = self.state
+            # a document uploaded under a known name replaces the old version
+            if document.name in state.documents:
+                if self.store is not None:
+                    self.store.log_delete(document.name)
+                state = self.__without_document(state, document.name)
+
+            if self.store is not None:
+                self.store.log_add(document, new_chunks, embeddings)
+
+            # the chunks, the vectors and the document become visible at once
+            self.state = self.__with_document(state, document, new_chunks, embeddings)
+
+            self.__schedule_compaction()
+
+            if self.store is not None and self.store.should_snapshot():
+                self.snapshot()
+
+        return None
 
     def get_document(self, name: str) -> str:
-        for document in self.documents:
-            if name == document.name:
-                pages = document.pages
-                return " ".join(pages)
+        document = self.state.documents.get(name)
+        if document is not None:
+            return " ".join(document.pages)
 
         return f"There is no document with the name {name} in the database"
 
-    def search(self, prompt: str, top_k: int = 1) -> str:
-        prompt_embedding = self.__get_embeddings(prompt)
+    def __nearest(
+        self,
+        state: EngineState,
+        embeddings: np.ndarray,
+        k: int,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """k-NN over the main and the recent vectors of a state"""
+        distances, indices = state.index.search(
+            embeddings,
+            k=k,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            exclude=state.deleted_chunks,
+        )
+        if state.recent.ntotal == 0:
+            return distances, indices
 
-        distances, indices = self.index.search(
-            prompt_embedding.data.cpu().numpy(), k=top_k
+        recent_distances, recent_indices = state.recent.search(
+            embeddings, k=k, exclude=state.deleted_chunks
         )
+        distances = np.concatenate([distances, recent_distances], axis=1)
+        indices = np.concatenate([indices, recent_indices], axis=1)
+        # missing neighbours come with an infinite or maximal distance
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+
+        return (
+            np.take_along_axis(distances, order, axis=1),
+            np.take_along_axis(indices, order, axis=1),
+        )
+
+    def search_many(
+        self,
+        prompts: list[str],
+        top_k: int = 1,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+    ) -> list[list[SearchResult]]:
+        """Nearest chunks of every prompt, closest first.
 
-        context = ""
-        for idx in indices[0]:
-            chunk_context = (
-                f"From document: {self.chunk_storage[idx].document_name}:\n"
-                + self.chunk_storage[idx].text
-                + "\n\n"
+        Prompts without a cached result are embedded in padded batches and looked
+        up with one multi-row index search.
+        """
+        state = self.state
+        keys = [
+            ("search", self.__normalize(prompt), top_k, nprobe, ef_search)
+            for prompt in prompts
+        ]
+        results = [self.result_cache.get(key, state.version) for key in keys]
+
+        missing = [
+            position for position, result in enumerate(results) if result is None
+        ]
+        if missing:
+            rows = self.__search_rows(
+                state,
+                [prompts[position] for position in missing],
+                top_k,
+                nprobe,
+                ef_search,
             )
-            context += chunk_context
+            for position, row in zip(missing, rows):
+                results[position] = row
+                self.result_cache.put(keys[position], state.version, row)
+
+        return results
+
+    def __search_rows(
+        self,
+        state: EngineState,
+        prompts: list[str],
+        top_k: int,
+        nprobe: int | None,
+        ef_search: int | None,
+    ) -> list[list[SearchResult]]:
+        if len(prompts) == 1:
+            prompt_embeddings = self.__get_embeddings(prompts[0])
+        else:
+            input_ids = self.tokenizer(prompts, truncation=True)["input_ids"]
+            prompt_embeddings = self.__get_embeddings_from_ids(input_ids, cache=False)
+
+        distances, indices = self.__nearest(
+            state, prompt_embeddings, top_k, nprobe=nprobe, ef_search=ef_search
+        )
+
+        results = []
+        for row_distances, row_indices in zip(distances.tolist(), indices.tolist()):
+            row = []
+            for distance, idx in zip(row_distances, row_indices):
+                # approximate indexes may return fewer than top_k neighbours
+                if idx < 0:
+                    continue
+
+                chunk = state.chunks[idx]
+                row.append(
+                    # squared distance of unit vectors is 2 - 2 * cosine
+                    SearchResult(idx, chunk.document_name, 1 - distance / 2, chunk.text)
+                )
+            results.append(row)
+
+        return results
+
+    def search(
+        self,
+        prompt: str,
+        top_k: int = 1,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+    ) -> str:
+        (results,) = self.search_many(
+            [prompt], top_k, nprobe=nprobe, ef_search=ef_search
+        )
+
+        return "".join(
+            f"From document: {result.document}:\n{result.text}\n\n"
+            for result in results
+        )
+
+    @staticmethod
+    def __own_chunks(state: EngineState, chunk_ids: np.ndarray) -> np.ndarray:
+        # the shared lexical index may already know chunks of later states and
+        # still knows the deleted ones
+        return chunk_ids[
+            (chunk_ids < state.num_chunks)
+            & ~np.isin(chunk_ids, state.deleted_chunks)
+        ]
+
+    def __lexical_documents(self, state: EngineState, fragment: str) -> np.ndarray:
+        """Ids of the documents containing the fragment, best matches first.
 
-        return context
+        The exact phrase is looked for first, then all of its terms anywhere in
+        one chunk.
+        """
+        fragment = self.__lexical_query(fragment)
+        chunk_ids, _ = state.lexical_index.search_phrase(fragment)
+        chunk_ids = self.__own_chunks(state, chunk_ids)
+        if len(chunk_ids) == 0:
+            chunk_ids, _ = state.lexical_index.search_keywords(fragment)
+            chunk_ids = self.__own_chunks(state, chunk_ids)
+
+        return _unique_in_order(state.chunks.document_ids(chunk_ids))
+
+    def __dense_documents(
+        self, state: EngineState, fragment: str, max_distance: float
+    ) -> np.ndarray:
+        """Ids of the documents with a chunk closer than `max_distance` to the
+        fragment, ordered by their closest chunk"""
+        if state.index.ntotal + state.recent.ntotal == 0:
+            return np.empty(0, dtype=np.int64)
 
-    def get_list_of_similar_documents(self, fragment: str) -> list[str]:
         fragment_embedding = self.__get_embeddings(fragment)
 
-        k = int(len(self.chunk_storage) / 2)
-        if k == 0:
-            k = 1
+        results = [
+            index.range_search(
+                fragment_embedding, max_distance, exclude=state.deleted_chunks
+            )
+            for index in (state.index, state.recent)
+            if index.ntotal > 0
+        ]
+        distances = np.concatenate([distances for distances, _ in results])
+        chunk_ids = np.concatenate([chunk_ids for _, chunk_ids in results])
+
+        return _unique_in_order(
+            state.chunks.document_ids(chunk_ids[np.argsort(distances)])
+        )
 
-        distances, indices = self.index.search(
-            fragment_embedding.data.cpu().numpy(), k=k
+    def __hybrid_documents(
+        self, state: EngineState, fragment: str, max_distance: float
+    ) -> np.ndarray:
+        """Reciprocal rank fusion of the lexical and the dense document rankings"""
+        chunk_ids, _ = state.lexical_index.search(
+            self.__lexical_query(fragment), top_k=None
         )
+        rankings = [
+            _unique_in_order(
+                state.chunks.document_ids(self.__own_chunks(state, chunk_ids))
+            ),
+            self.__dense_documents(state, fragment, max_distance),
+        ]
+
+        scores = {}
+        for ranking in rankings:
+            for rank, document_id in enumerate(ranking.tolist()):
+                scores[document_id] = scores.get(document_id, 0.0) + 1 / (
+                    RRF_K + rank + 1
+                )
+
+        return np.array(
+            sorted(scores, key=scores.get, reverse=True), dtype=np.int64
+        )
+
+    def get_list_of_similar_documents(
+        self, fragment: str, max_distance: float = 0.5, mode: str = "lexical"
+    ) -> list[str]:
+        """Names of the documents matching the fragment, best matches first.
+
+        `mode` is one of "lexical" (exact phrase or keywords), "dense" (chunks
+        closer than `max_distance` to the fragment) or "hybrid" (both fused).
+        """
+        state = self.state
+        key = ("search_similar", self.__normalize(fragment), mode, max_distance)
+        names = self.result_cache.get(key, state.version)
+        if names is not None:
+            return names
+
+        if mode == "lexical":
+            document_ids = self.__lexical_documents(state, fragment)
+        elif mode == "dense":
+            document_ids = self.__dense_documents(state, fragment, max_distance)
+        elif mode == "hybrid":
+            document_ids = self.__hybrid_documents(state, fragment, max_distance)
+        else:
+            raise ValueError(
+                f"Unknown search mode {mode}, expected one of {SEARCH_MODES}"
+            )
+
+        names = [state.document_names[document_id] for document_id in document_ids]
+        self.result_cache.put(key, state.version, names)
+
+        return names
 
-        search_result = set()
-        for distance_id, distance in enumerate(distances[0]):
-            if distance <= 0.5:
-                chunk_id = indices[0][distance_id]
-                search_result.add(self.chunk_storage[chunk_id].document_name)
+    def stats(self) -> dict:
+        state = self.state
 
-        return search_result
+        return {
+            "generation": state.generation,
+            "version": state.version,
+            "documents": len(state.documents),
+            "chunks": state.num_chunks,
+            "recent_vectors": state.recent.ntotal,
+            "lexical_terms": len(state.lexical_index.postings),
+            "duplicate_uploads": self.duplicate_uploads,
+            "deleted_documents": len(state.deleted_documents),
+            "tombstoned_chunks": len(state.deleted_chunks),
+            "embedding_cache": self.embedding_cache.stats(),
+            "query_batching": self.query_batcher.stats(),
+            "result_cache": self.result_cache.stats(),
+        }
@@ -0,0 +1,108 @@
+from pathlib import Path
+
+import numpy as np
+
+import os
+import threading
+
+
+def _numbered_files(base: Path) -> dict[int, Path]:
+    """Files `<base>.<number>` of a float store, by number"""
+    files = {}
+    for path in base.parent.glob(f"{base.name}.*"):
+        suffix = path.name[len(base.name) + 1 :]
+        if suffix.isdigit():
+            files[int(suffix)] = path
+
+    return files
+
+
+class FloatVectorStore:
+    """Full-precision vectors kept on disk and read through a memory map.
+
+    The vector with id `i` is row `i` of the file, so rows are written in place
+    and a lookup costs one page read per vector instead of resident memory.
+
+    A file only ever gets rows of new ids. Renumbered contents go to the next
+    file `<base>.<number>`, so that the states and snapshots using the previous
+    file keep reading the vectors they were built with.
+    """
+
+    def __init__(self, path: str, dimension: int):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.touch(exist_ok=True)
+        self.d = dimension
+        self.row_size = dimension * np.dtype(np.float32).itemsize
+
+        self.lock = threading.Lock()
+        self.map: np.memmap | None = None
+
+    @classmethod
+    def latest(cls, base: str, dimension: int) -> "FloatVectorStore":
+        """The most recent file of the store at `base`, or its first one"""
+        files = _numbered_files(Path(base))
+        path = files[max(files)] if files else f"{base}.0"
+
+        return cls(path, dimension)
+
+    @property
+    def base(self) -> Path:
+        return self.path.with_name(self.path.name.rsplit(".", 1)[0])
+
+    def __len__(self):
+        return self.path.stat().st_size // self.row_size
+
+    def __write(self, f, vectors: np.ndarray, ids: np.ndarray) -> None:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        ids = np.asarray(ids, dtype=np.int64)
+
+        if len(ids) > 0 and np.all(np.diff(ids) == 1):
+            # the chunks of a document have consecutive ids
+            f.seek(int(ids[0]) * self.row_size)
+            f.write(vectors.tobytes())
+        else:
+            for vector_id, vector in zip(ids, vectors):
+                f.seek(int(vector_id) * self.row_size)
+                f.write(vector.tobytes())
+
+    def put(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        with open(self.path, "r+b") as f:
+            self.__write(f, vectors, ids)
+
+    def get(self, ids: np.ndarray) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return np.empty((0, self.d), dtype=np.float32)
+
+        with self.lock:
+            # the file only grows, the map is renewed to cover it
+            if self.map is None or ids.max() >= len(self.map):
+                self.map = np.memmap(
+                    self.path, dtype=np.float32, mode="r", shape=(len(self), self.d)
+                )
+            vector_map = self.map
+
+        return np.array(vector_map[ids])
+
+    def rewritten(self, vectors: np.ndarray, ids: np.ndarray) -> "FloatVectorStore":
+        """New store holding only the given vectors, in the next file.
+
+        This store and its file stay as they are. Files older than this one are
+        no longer used by the current or the previous snapshot and are removed.
+        """
+        files = _numbered_files(self.base)
+        path = self.path.with_name(f"{self.base.name}.{max(files, default=0) + 1}")
+
+        temporary_path = path.with_suffix(".tmp")
+        with open(temporary_path, "wb") as f:
+            self.__write(f, vectors, ids)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+
+        for old_path in files.values():
+            if old_path != self.path:
+                old_path.unlink(missing_ok=True)
+
+        return FloatVectorStore(str(path), self.d)